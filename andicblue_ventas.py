@@ -4,6 +4,7 @@
 #  - Python >= 3.9
 #  - pip install streamlit pandas gspread google-auth plotly reportlab
 #  - st.secrets["gcp_service_account"] (opcional — si quieres usar Google Sheets)
+#  - st.secrets["sheet_id"] (opcional — ID del spreadsheet; evita buscarlo por nombre en Drive)
 #
 # Instrucciones:
 # 1. Crea carpeta 'data/' en el mismo directorio que este script.
@@ -17,13 +18,18 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
+import pyarrow as pa
 import os
-import json
+import re
 import time
 import math
 import logging
+import threading
+import atexit
 import base64
-from typing import Any, Dict, List, Tuple
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 from datetime import datetime, date, timedelta
 from pathlib import Path
 from io import BytesIO
@@ -32,10 +38,20 @@ from io import BytesIO
 try:
     import gspread
     from google.oauth2.service_account import Credentials
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     GS_AVAILABLE = True
 except Exception:
     GS_AVAILABLE = False
 
+# Optional faster JSON for Sheets request/response bodies
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except Exception:
+    ORJSON_AVAILABLE = False
+
 # Optional plotting
 try:
     import plotly.express as px
@@ -92,8 +108,24 @@ LOGO_PATH = Path("andicblue_logo.png")
 # Google Sheet name (if using)
 SHEET_NAME = "andicblue_pedidos"
 
+# Segundos que se reutilizan las lecturas cacheadas antes de volver a Sheets/CSV
+SHEETS_CACHE_TTL = 30
+# Cupo de escrituras de la API (60/min por usuario): el hilo de escritura se mantiene un poco por debajo
+SHEETS_WRITES_PER_MINUTE = 55
+# Lecturas de Sheets con los valores guardados (números como números, sin formato) y fechas como texto
+SHEETS_READ_PARAMS = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"}
+
 DOMICILIO_COST = 3000  # COP
 
+# Filas por página en las tablas de Reportes
+REPORT_PAGE_SIZE = 100
+
+# Medios de pago disponibles (tupla constante: no se reconstruye en cada rerun)
+MEDIOS_PAGO = ("Efectivo", "Transferencia", "Nequi", "Daviplata")
+# Límites de los campos de monto en los formularios de flujo de caja
+MONTO_MIN_COP = 0.0
+MONTO_STEP_COP = 1000.0
+
 # HEADERS - ensure consistent ordering
 HEAD_CLIENTES = ["ID Cliente", "Nombre", "Tipo Documento", "Numero Documento", "Telefono", "Direccion"]
 HEAD_PEDIDOS = [
@@ -110,6 +142,24 @@ HEAD_FLUJO = [
 HEAD_GASTOS = ["Fecha", "Concepto", "Monto"]
 HEAD_PRODUCTOS = ["ID Producto", "Nombre", "Precio", "Costo"]
 
+# Columnas de montos/cantidades: se tipan como numéricas (vacío -> 0) una sola vez al cargar
+NUMERIC_COLUMNS = {
+    "Pedidos": ["Subtotal_productos", "Monto_domicilio", "Total_pedido", "Descuento", "Monto_pagado", "Saldo_pendiente"],
+    "Pedidos_detalle": ["Cantidad", "Precio_unitario", "Subtotal"],
+    "Inventario": ["Stock"],
+    "FlujoCaja": ["Ingreso_productos_recibido", "Ingreso_domicilio_recibido", "Saldo_pendiente_total"],
+    "Gastos": ["Monto"],
+    "Productos": ["Precio", "Costo"],
+}
+# IDs y stock: enteros desde la carga, para que las altas/ediciones comparen sin volver a convertir la columna
+INTEGER_COLUMNS = {
+    "Clientes": ["ID Cliente"],
+    "Pedidos": ["ID Pedido", "ID Cliente"],
+    "Pedidos_detalle": ["ID Pedido"],
+    "Inventario": ["Stock"],
+    "Productos": ["ID Producto"],
+}
+
 # Logging config
 logging.basicConfig(
     filename=str(CSV_LOG),
@@ -175,31 +225,117 @@ ensure_csv_with_headers(CSV_PRODUCTOS, HEAD_PRODUCTOS)
 GS_CLIENT = None
 GS_SPREADSHEET = None
 
+@st.cache_resource(show_spinner=False)
+def get_gs_handles() -> Dict[str, Any]:
+    """Cliente, spreadsheet y worksheets de gspread compartidos entre reruns (se autentica una sola vez).
+
+    stale_grid: hojas cuyo handle sigue sirviendo (sheetId) pero con row_count/col_count desactualizados.
+    header_rows: fila 1 ya verificada (o escrita) por la app en hojas que aún no se han leído.
+    sa_info: la cuenta de servicio como dict simple, leída de st.secrets una sola vez.
+    """
+    return {"client": None, "spreadsheet": None, "spreadsheet_id": None, "worksheets": {}, "stale_grid": set(),
+            "header_rows": {}, "sa_info": None}
+
+def reset_gs_handles():
+    """Descarta la conexión cacheada; el próximo init_gs_client vuelve a autenticar (el ID del spreadsheet se conserva)."""
+    global GS_CLIENT, GS_SPREADSHEET
+    handles = get_gs_handles()
+    handles["client"] = None
+    handles["spreadsheet"] = None
+    handles["worksheets"].clear()
+    handles["stale_grid"].clear()
+    handles["header_rows"].clear()
+    GS_CLIENT = None
+    GS_SPREADSHEET = None
+
+def open_spreadsheet():
+    """Abre el spreadsheet por ID si ya se conoce (solo spreadsheets.get); por nombre hace además una búsqueda en Drive."""
+    handles = get_gs_handles()
+    key = handles["spreadsheet_id"] or st.secrets.get("sheet_id")
+    ss = GS_CLIENT.open_by_key(key) if key else GS_CLIENT.open(SHEET_NAME)
+    handles["spreadsheet_id"] = ss.id
+    return ss
+
+def mark_grid_stale(*titles: str):
+    """Tras agregar o borrar filas: el handle se conserva y solo se pide de nuevo si hace falta el tamaño de la grilla."""
+    get_gs_handles()["stale_grid"].update(titles)
+
+def is_auth_error(msg: str) -> bool:
+    return "[401]" in msg or "UNAUTHENTICATED" in msg or "invalid_grant" in msg
+
+def sheets_http_session(creds) -> "AuthorizedSession":
+    """Sesión HTTP de gspread que reintenta en la capa de transporte, respetando Retry-After.
+
+    Un 429 se reintenta siempre (la API no aplicó la petición); los 5xx solo en GET/PUT,
+    porque un POST (batchUpdate, append) pudo haberse aplicado antes del error.
+    Si orjson está instalado, los cuerpos JSON (lecturas y batchUpdate grandes) se codifican y decodifican con él.
+    """
+    class SheetsRetry(Retry):
+        def is_retry(self, method, status_code, has_retry_after=False):
+            if status_code >= 500 and method.upper() not in ("GET", "PUT"):
+                return False
+            return super().is_retry(method, status_code, has_retry_after)
+
+    retry = SheetsRetry(total=6, connect=3, read=0, backoff_factor=0.5,
+                        status_forcelist=(429, 500, 502, 503, 504), allowed_methods=None,
+                        respect_retry_after_header=True, raise_on_status=False)
+
+    class SheetsSession(AuthorizedSession):
+        def request(self, method, url, data=None, headers=None, **kwargs):
+            body = kwargs.pop("json", None)
+            if body is not None:
+                data = orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY)
+                headers = {**(headers or {}), "Content-Type": "application/json"}
+            response = super().request(method, url, data=data, headers=headers, **kwargs)
+            response.json = lambda **_: orjson.loads(response.content)
+            return response
+
+    session = (SheetsSession if ORJSON_AVAILABLE else AuthorizedSession)(creds)
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    return session
+
 def init_gs_client():
     global GS_CLIENT, GS_SPREADSHEET
+    handles = get_gs_handles()
+    if handles["client"] is not None:
+        GS_CLIENT = handles["client"]
+        GS_SPREADSHEET = handles["spreadsheet"]
+        return True
     if not GS_AVAILABLE:
         log_warn("gspread/google-auth not available, Sheets functionality disabled.")
         return False
-    if "gcp_service_account" not in st.secrets:
-        log_warn("No st.secrets['gcp_service_account'] found. Sheets disabled until provided.")
-        return False
+    if handles["sa_info"] is None:
+        if "gcp_service_account" not in st.secrets:
+            log_warn("No st.secrets['gcp_service_account'] found. Sheets disabled until provided.")
+            return False
+        # Re-autenticar (p. ej. tras un 401) reutiliza este dict sin volver a recorrer los secrets
+        handles["sa_info"] = dict(st.secrets["gcp_service_account"])
     try:
-        creds = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=[
+        creds = Credentials.from_service_account_info(handles["sa_info"], scopes=[
             "https://www.googleapis.com/auth/spreadsheets",
             "https://www.googleapis.com/auth/drive"
         ])
-        GS_CLIENT = gspread.authorize(creds)
+        GS_CLIENT = gspread.authorize(creds, session=sheets_http_session(creds))
         try:
-            GS_SPREADSHEET = GS_CLIENT.open(SHEET_NAME)
+            GS_SPREADSHEET = open_spreadsheet()
         except Exception:
             GS_SPREADSHEET = None
+        handles["client"] = GS_CLIENT
+        handles["spreadsheet"] = GS_SPREADSHEET
         log_info("Google Sheets client inicializado (OK).")
+        ensure_sheets()
         return True
     except Exception as e:
         log_error(f"Error inicializando Google Sheets client: {e}")
         return False
 
-init_gs_client()
+def reopen_worksheet(title: str):
+    """Re-autentica tras un 401 y devuelve un handle nuevo de la hoja (o None)."""
+    log_warn(f"Sheets auth error on {title}, re-opening connection.")
+    reset_gs_handles()
+    if not init_gs_client():
+        return None
+    return safe_get_worksheet(title)
 
 def exponential_backoff(attempt: int):
     delay = min(10, 0.5 * (2 ** attempt))
@@ -209,21 +345,33 @@ def safe_get_worksheet(title: str):
     global GS_SPREADSHEET
     if GS_CLIENT is None:
         return None
+    handles = get_gs_handles()
+    if title in handles["worksheets"]:
+        return handles["worksheets"][title]
     for attempt in range(5):
         try:
             if GS_SPREADSHEET is None:
-                GS_SPREADSHEET = GS_CLIENT.open(SHEET_NAME)
+                GS_SPREADSHEET = open_spreadsheet()
+                handles["spreadsheet"] = GS_SPREADSHEET
             ws = GS_SPREADSHEET.worksheet(title)
+            handles["worksheets"][title] = ws
             return ws
         except Exception as e:
             msg = str(e)
-            if "Quota exceeded" in msg or "rateLimitExceeded" in msg or "[429]" in msg:
-                log_warn(f"Sheets quota exceeded when accessing {title}. Attempt {attempt+1}/5.")
-                exponential_backoff(attempt)
+            if is_auth_error(msg) and attempt == 0:
+                reset_gs_handles()
+                if not init_gs_client():
+                    return None
+                handles = get_gs_handles()
                 continue
+            if "Quota exceeded" in msg or "rateLimitExceeded" in msg or "[429]" in msg:
+                # La sesión HTTP ya reintentó con espera; no es una hoja faltante
+                log_warn(f"Sheets quota exceeded when accessing {title}.")
+                return None
             try:
                 GS_SPREADSHEET.add_worksheet(title=title, rows=1000, cols=20)
                 ws = GS_SPREADSHEET.worksheet(title)
+                handles["worksheets"][title] = ws
                 return ws
             except Exception as ex:
                 log_warn(f"Error creating worksheet {title}: {ex}")
@@ -232,87 +380,762 @@ def safe_get_worksheet(title: str):
     log_warn(f"No pude obtener worksheet {title} de Google Sheets.")
     return None
 
-def ensure_sheet_headers(ws, headers: List[str]):
+def ensure_sheet_headers(ws, headers: List[str], first_row: List[str] = None, fix: bool = True) -> bool:
+    """Ensure row 1 holds the headers. Returns True only if they were already in place.
+
+    first_row can come from an earlier read of the sheet to skip the row_values(1) request.
+    With fix=False nothing is written (the caller is about to rewrite the whole sheet anyway).
+    """
     if ws is None:
-        return
+        return False
     try:
-        first_row = ws.row_values(1)
-        if first_row != headers:
-            try:
-                if ws.row_count >= 1 and ws.row_values(1):
-                    ws.delete_rows(1)
-            except Exception:
-                pass
-            try:
-                ws.insert_row(headers, index=1)
-            except Exception:
-                try:
-                    ws.append_row(headers)
-                except Exception:
-                    pass
+        if first_row is None:
+            acquire_write_token()
+            first_row = ws.row_values(1)
+        if first_row == headers:
+            get_gs_handles()["header_rows"][ws.title] = list(headers)
+            return True
+        if not fix:
+            return False
+        requests = []
+        if not first_row:
+            # Fila 1 vacía: se inserta una fila para no pisar lo que haya debajo
+            requests.append({"insertDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": 0, "endIndex": 1}}})
+        # Fila 1 completa (sin límite de columnas): los headers reemplazan los viejos y lo sobrante queda vacío
+        requests.append({"updateCells": {
+            "range": {"sheetId": ws.id, "startRowIndex": 0, "endRowIndex": 1},
+            "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in headers]}],
+            "fields": "userEnteredValue",
+        }})
+        acquire_write_token()
+        GS_SPREADSHEET.batch_update({"requests": requests})
+        # La fila 1 ya no es la que se leyó: se corrige la baseline para no volver a "arreglarla"
+        sheet_snapshots().pop(ws.title, None)
+        baseline = sheet_baselines().get(ws.title)
+        if baseline is not None:
+            baseline[:1 if first_row else 0] = normalize_sheet_values([headers])
+        if not first_row:
+            mark_grid_stale(ws.title)
+        get_gs_handles()["header_rows"][ws.title] = list(headers)
     except Exception as e:
         log_warn(f"Error asegurando headers en sheet: {e}")
+    return False
+
+# Hojas que lee la app; las que estén vencidas se piden juntas en un solo values.batchGet
+SHEET_HEADERS = {
+    "Clientes": HEAD_CLIENTES,
+    "Pedidos": HEAD_PEDIDOS,
+    "Pedidos_detalle": HEAD_PEDIDOS_DETALLE,
+    "Inventario": HEAD_INVENTARIO,
+    "FlujoCaja": HEAD_FLUJO,
+    "Gastos": HEAD_GASTOS,
+    "Productos": HEAD_PRODUCTOS,
+}
+# Hojas que entran al batchGet por defecto (todas); MENU_SHEETS las acota según el módulo elegido
+BATCH_SHEETS = tuple(SHEET_HEADERS)
+
+# Hojas que usa cada módulo: solo esas se piden a Sheets en el rerun (un único batchGet)
+MENU_SHEETS = {
+    "Dashboard": ["Pedidos", "Pedidos_detalle", "FlujoCaja", "Gastos", "Inventario", "Clientes", "Productos"],
+    "Clientes": ["Clientes", "Pedidos"],
+    "Productos": ["Productos"],
+    "Pedidos": ["Clientes", "Pedidos", "Pedidos_detalle", "Inventario", "Productos"],
+    "Entregas/Pagos": ["Pedidos", "Pedidos_detalle", "FlujoCaja"],
+    "Inventario": ["Inventario", "Productos"],
+    "Flujo & Gastos": ["FlujoCaja", "Gastos"],
+    "Facturación 🧾": ["Pedidos", "Pedidos_detalle", "Clientes"],
+    "Reportes": ["Pedidos", "Pedidos_detalle", "FlujoCaja", "Gastos", "Inventario", "Productos"],
+}
+
+# Clave de fila por hoja: con ella se re-aplican los cambios propios si otra instancia escribió la hoja antes
+SHEET_ROW_KEYS = {
+    "Clientes": ["ID Cliente"],
+    "Pedidos": ["ID Pedido"],
+    "Pedidos_detalle": ["ID Pedido", "Producto"],
+    "Inventario": ["Producto"],
+    "Productos": ["ID Producto"],
+}
+# Columnas que se fusionan sumando la diferencia (dos pedidos simultáneos descuentan ambos del stock)
+SHEET_ADDITIVE_COLUMNS = {"Inventario": ["Stock"]}
+
+@st.cache_resource(show_spinner=False)
+def sheet_snapshots() -> Dict[str, Tuple[int, float, List[List[Any]]]]:
+    """Última matriz leída de cada hoja: (versión, momento de lectura, valores)."""
+    return {}
+
+@st.cache_resource(show_spinner=False)
+def sheet_baselines() -> Dict[str, List[List[Any]]]:
+    """Último contenido (normalizado) que esta app leyó o escribió en cada hoja: lo que se espera encontrar al reescribirla."""
+    return {}
+
+def existing_sheet_titles():
+    """Títulos de las pestañas del spreadsheet (una sola llamada de metadatos) o None si falla.
+
+    De paso deja cacheados los handles de todas las pestañas, así safe_get_worksheet no las pide una a una.
+    """
+    try:
+        worksheets = GS_SPREADSHEET.worksheets()
+    except Exception as e:
+        log_warn(f"Could not list worksheets: {e}")
+        return None
+    handles = get_gs_handles()
+    handles["worksheets"].update({ws.title: ws for ws in worksheets})
+    handles["stale_grid"].difference_update(handles["worksheets"])
+    return {ws.title for ws in worksheets}
+
+def create_sheets_with_headers(titles: List[str]) -> bool:
+    """Crea las pestañas indicadas, con su fila de headers, en un solo batchUpdate (addSheet + updateCells)."""
+    next_id = max((ws.id for ws in get_gs_handles()["worksheets"].values()), default=0) + 1
+    requests = []
+    for i, t in enumerate(titles):
+        # El sheetId se fija acá para poder escribir los headers en el mismo request
+        sheet_id = next_id + i
+        headers = SHEET_HEADERS.get(t, [])
+        requests.append({"addSheet": {"properties": {
+            "title": t, "sheetId": sheet_id,
+            "gridProperties": {"rowCount": 1000, "columnCount": max(20, len(headers))},
+        }}})
+        if headers:
+            requests.append({"updateCells": {
+                "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in headers]}],
+                "fields": "userEnteredValue",
+            }})
+    try:
+        GS_SPREADSHEET.batch_update({"requests": requests})
+    except Exception as e:
+        log_warn(f"Error creating sheets {titles}: {e}")
+        return False
+    get_gs_handles()["header_rows"].update({t: list(SHEET_HEADERS[t]) for t in titles if SHEET_HEADERS.get(t)})
+    existing_sheet_titles()
+    log_info(f"Created sheets {titles} with headers in a single batchUpdate request.")
+    return True
+
+def ensure_sheets():
+    """Al conectar: cachea los handles de todas las pestañas y crea de una vez las de SHEET_HEADERS que falten."""
+    if GS_SPREADSHEET is None:
+        return
+    existing = existing_sheet_titles()
+    if existing is None:
+        return
+    missing = [t for t in SHEET_HEADERS if t not in existing]
+    if missing:
+        create_sheets_with_headers(missing)
+
+init_gs_client()
+
+def read_sheet_values(sheet_title: str, prefetch: Sequence[str] = BATCH_SHEETS):
+    """Valores de la hoja (fila 1 = headers) o None si Sheets no está disponible.
+
+    Si hay que ir a Sheets, se aprovecha el mismo request para refrescar las hojas vencidas de prefetch.
+    """
+    if GS_CLIENT is None:
+        return None
+    snaps = sheet_snapshots()
+    versions = sheet_versions()
+    now = time.time()
+
+    def is_fresh(title: str) -> bool:
+        snap = snaps.get(title)
+        return snap is not None and snap[0] == versions.get(title, 0) and now - snap[1] < SHEETS_CACHE_TTL
+
+    if is_fresh(sheet_title):
+        return snaps[sheet_title][2]
+    stale = [t for t in prefetch if not is_fresh(t)]
+    if sheet_title not in stale:
+        stale.append(sheet_title)
+    stale_versions = {t: versions.get(t, 0) for t in stale}
 
-def safe_read_sheet_to_df(sheet_title: str, headers: List[str]) -> pd.DataFrame:
-    ws = safe_get_worksheet(sheet_title)
-    if ws is None:
-        log_warn(f"Worksheet {sheet_title} not available, loading local CSV fallback.")
-        return load_local_csv_by_sheet(sheet_title)
     for attempt in range(5):
         try:
-            records = ws.get_all_records()
-            df = pd.DataFrame(records)
-            if df.empty:
-                df = pd.DataFrame(columns=headers)
-            return df
+            resp = GS_SPREADSHEET.values_batch_get([f"'{t}'" for t in stale], params=SHEETS_READ_PARAMS)
+            for t, value_range in zip(stale, resp.get("valueRanges", [])):
+                snaps[t] = (stale_versions[t], now, value_range.get("values", []))
+                sheet_baselines()[t] = normalize_sheet_values(snaps[t][2])
+            return snaps[sheet_title][2]
         except Exception as e:
             msg = str(e)
+            if is_auth_error(msg) and attempt == 0:
+                reset_gs_handles()
+                if init_gs_client() and GS_SPREADSHEET is not None:
+                    continue
             if "Quota exceeded" in msg or "rateLimitExceeded" in msg or "[429]" in msg:
-                log_warn(f"Quota exceeded reading sheet {sheet_title}, attempt {attempt+1}")
-                exponential_backoff(attempt)
-                continue
-            else:
-                log_warn(f"Error reading sheet {sheet_title}: {e}")
-                break
-    log_warn(f"Failed reading sheet {sheet_title}, using local CSV fallback.")
-    return load_local_csv_by_sheet(sheet_title)
+                # La sesión HTTP ya reintentó con espera: se sirve el respaldo local
+                log_warn(f"Quota exceeded reading sheets: {e}")
+                return None
+            # Una hoja que aún no existe hace fallar el lote completo: se crean las que faltan y se repite
+            existing = existing_sheet_titles()
+            missing = [t for t in stale if existing is not None and t not in existing]
+            if missing:
+                log_warn(f"Batch read failed ({e}); creating missing sheets {missing} and retrying.")
+                if create_sheets_with_headers(missing):
+                    continue
+            log_warn(f"Batch read failed ({e}); reading sheet {sheet_title} alone.")
+            break
+    else:
+        return None
 
-def safe_write_df_to_sheet(df: pd.DataFrame, sheet_title: str, headers: List[str]) -> bool:
-    """Overwrite the Google Sheet with the DataFrame in a single batch update."""
     ws = safe_get_worksheet(sheet_title)
     if ws is None:
-        log_warn(f"Cannot write to sheet {sheet_title} (ws None).")
-        return False
+        return None
+    try:
+        # values_get directo: la matriz cruda del API, sin el relleno por celda de get_all_values
+        values = GS_SPREADSHEET.values_get(f"'{sheet_title}'", params=SHEETS_READ_PARAMS).get("values", [])
+        snaps[sheet_title] = (stale_versions[sheet_title], now, values)
+        sheet_baselines()[sheet_title] = normalize_sheet_values(values)
+        return values
+    except Exception as e:
+        log_warn(f"Error reading sheet {sheet_title}: {e}")
+        return None
+
+def cached_header_row(sheet_title: str):
+    """Fila 1 de la hoja según la última lectura vigente o, si no hay, lo último leído/escrito por la app; o None."""
+    snap = sheet_snapshots().get(sheet_title)
+    if snap is not None and snap[0] == sheet_versions().get(sheet_title, 0) and snap[2]:
+        return [str(h) for h in snap[2][0]]
+    # Tras cada escritura se descarta el snapshot, pero la baseline ya tiene la fila 1 que quedó en la hoja
+    baseline = sheet_baselines().get(sheet_title)
+    if baseline:
+        return [str(h) for h in baseline[0]]
+    # Hoja aún sin leer: la fila 1 que la app verificó o escribió, sin volver a pedir row_values(1)
+    return get_gs_handles()["header_rows"].get(sheet_title)
+
+def values_to_df(values: List[List[Any]], headers: List[str]) -> pd.DataFrame:
+    """Matriz de valores -> DataFrame, con las columnas numéricas tipadas igual que read_csv."""
+    if not values or not values[0]:
+        return pd.DataFrame(columns=headers)
+    head = [str(h) for h in values[0]]
+    width = len(head)
+    body = values[1:]
+    if any(len(r) > width for r in body):
+        body = [r[:width] for r in body]
+    # Sheets omite las celdas vacías al final de cada fila: se completan al construir, sin rellenar fila por fila
+    df = pd.DataFrame(body, dtype=object).reindex(columns=range(width), fill_value="")
+    df.columns = head
+    df = df.mask(df.isna() | (df == ""))
+    df = df.dropna(how="all").reset_index(drop=True)
+    for c in head:
+        col = df[c]
+        present = col.notna()
+        n_present = int(present.sum())
+        if n_present == 0:
+            continue  # columna vacía: se deja como object para poder escribir texto después
+        first = col[present].iat[0]
+        if isinstance(first, str):
+            # Con lecturas sin formato los números ya llegan como números: texto solo se intenta si el primero lo parece
+            try:
+                float(first)
+            except ValueError:
+                continue
+        num = pd.to_numeric(col, errors="coerce")
+        if num.notna().sum() == n_present:
+            df[c] = num
+    return df
+
+def safe_read_sheet_to_df(sheet_title: str, headers: List[str], prefetch: Sequence[str] = BATCH_SHEETS) -> pd.DataFrame:
+    values = read_sheet_values(sheet_title, prefetch)
+    if values is None:
+        log_warn(f"Sheet {sheet_title} not available, loading local CSV fallback.")
+        return load_local_csv_by_sheet(sheet_title)
+    return values_to_df(values, headers)
+
+def sheet_rows_from_df(df: pd.DataFrame, headers: List[str]) -> List[List[Any]]:
+    """Header row + data rows as plain Python values (NaN -> "")."""
     try:
-        df_to_write = df.copy().reindex(columns=headers)
+        df_to_write = df.reindex(columns=headers)  # reindex ya devuelve una tabla nueva
     except Exception:
         df_to_write = df.copy()
         for h in headers:
             if h not in df_to_write.columns:
                 df_to_write[h] = ""
         df_to_write = df_to_write[headers]
-    
-    df_to_write = df_to_write.where(pd.notnull(df_to_write), "")
-    rows = [headers] + df_to_write.values.tolist()
-    
-    for attempt in range(5):
+
+    # Una sola conversión a object y el reemplazo de vacíos en el mismo arreglo, sin otra tabla intermedia
+    values = df_to_write.to_numpy(dtype=object)
+    values[pd.isna(values)] = ""
+    return [headers] + values.tolist()
+
+def normalize_cell(v) -> Any:
+    """Valor comparable entre lo escrito (números de Python) y lo leído (texto): números -> float, vacío -> ""."""
+    if v is None:
+        return ""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        # Lecturas sin formato: la mayoría de las celdas numéricas ya son números, sin pasar por texto
+        f = float(v)
+        if math.isfinite(f):
+            return f
+    s = str(v).strip()
+    if s == "" or s.lower() == "nan":
+        return ""
+    if not (s[0].isdigit() or s[0] in "+-.iI"):
+        return s  # no puede ser un número: se evita el float() con excepción por cada celda de texto
+    try:
+        f = float(s)
+    except ValueError:
+        return s
+    return f if math.isfinite(f) else s
+
+def normalize_row(row: List[Any]) -> List[Any]:
+    """Fila normalizada sin celdas vacías al final ([] si está en blanco)."""
+    r = [normalize_cell(v) for v in row]
+    while r and r[-1] == "":
+        r.pop()
+    return r
+
+def normalize_sheet_values(values: List[List[Any]]) -> List[List[Any]]:
+    """Filas normalizadas, sin celdas vacías al final ni filas en blanco (Sheets no las devuelve)."""
+    return [r for r in map(normalize_row, values) if r]
+
+def rebase_sheet_rows(rows: List[List[Any]], base: List[List[Any]], current: List[List[Any]],
+                      sheet_title: str, headers: List[str]):
+    """Re-aplica sobre el contenido actual de la hoja los cambios de rows respecto a base (filas por clave).
+
+    Devuelve el DataFrame fusionado, o None si la hoja no tiene clave o las claves no son únicas.
+    """
+    keys = SHEET_ROW_KEYS.get(sheet_title)
+    if not keys or not current or [str(h) for h in current[0][:len(headers)]] != headers:
+        return None
+    width = len(headers)
+    key_idx = [headers.index(k) for k in keys]
+    add_idx = [headers.index(c) for c in SHEET_ADDITIVE_COLUMNS.get(sheet_title, [])]
+
+    def by_key(table: List[List[Any]]):
+        """{clave normalizada: (fila normalizada, fila original)}; None si hay claves repetidas."""
+        out = {}
+        for raw in table[1:]:
+            raw = (list(raw) + [""] * width)[:width]
+            norm = [normalize_cell(v) for v in raw]
+            if all(v == "" for v in norm):
+                continue
+            k = tuple(norm[i] for i in key_idx)
+            if k in out:
+                return None
+            out[k] = (norm, raw)
+        return out
+
+    ours, prev, cur = by_key(rows), by_key([headers] + base[1:]), by_key(current)
+    if ours is None or prev is None or cur is None:
+        return None
+    merged = {k: raw for k, (_, raw) in cur.items()}
+    for k, (norm, raw) in ours.items():
+        if k in prev and prev[k][0] == norm:
+            continue  # fila que no tocamos: se deja la versión actual
+        row = list(raw)
+        if k in prev and k in cur:
+            for i in add_idx:
+                mine, was, now_v = norm[i], prev[k][0][i], cur[k][0][i]
+                if all(isinstance(v, float) for v in (mine, was, now_v)):
+                    total = now_v + (mine - was)
+                    row[i] = int(total) if total.is_integer() else total
+        merged[k] = row
+    for k in prev:
+        if k not in ours:
+            merged.pop(k, None)  # fila que borramos
+    # values_to_df ya trata None como celda vacía: las filas pasan tal cual
+    return values_to_df([headers] + list(merged.values()), headers)
+
+def rebase_on_remote(frames: List[Tuple[pd.DataFrame, str, List[str]]]):
+    """Precondición de escritura: compara cada hoja con su baseline y, si otra instancia la cambió,
+    re-aplica nuestros cambios sobre lo actual en vez de pisarlo. Devuelve (frames, hojas fusionadas)."""
+    baselines = sheet_baselines()
+    titles = [t for _, t, _ in frames if t in baselines]
+    if not titles or GS_SPREADSHEET is None:
+        return frames, []
+    try:
+        acquire_write_token()
+        resp = GS_SPREADSHEET.values_batch_get([f"'{t}'" for t in titles], params=SHEETS_READ_PARAMS)
+    except Exception as e:
+        log_warn(f"Could not check sheets {titles} before writing ({e}); writing anyway.")
+        return frames, []
+    current = {t: vr.get("values", []) for t, vr in zip(titles, resp.get("valueRanges", []))}
+    out, merged_titles = [], []
+    for df, t, headers in frames:
+        cur = current.get(t)
+        if cur is None or normalize_sheet_values(cur) == baselines[t]:
+            out.append((df, t, headers))
+            continue
+        merged = rebase_sheet_rows(sheet_rows_from_df(df, headers), baselines[t], cur, t, headers)
+        if merged is None:
+            log_warn(f"Sheet {t} changed since it was read and can't be merged by row; overwriting it.")
+            out.append((df, t, headers))
+        else:
+            log_warn(f"Sheet {t} changed since it was read; re-applied local changes on top of it.")
+            out.append((merged, t, headers))
+            merged_titles.append(t)
+    return out, merged_titles
+
+def safe_write_df_to_sheet(df: pd.DataFrame, sheet_title: str, headers: List[str], rebase: bool = True) -> bool:
+    """Overwrite the Google Sheet with the DataFrame in a single batch update.
+
+    With rebase, changes made to the sheet by someone else since it was last read are kept (see rebase_on_remote).
+    """
+    # Un solo updateCells sobre toda la hoja escribe y limpia lo sobrante (antes: clear + update)
+    return safe_write_dfs_to_sheets([(df, sheet_title, headers)], rebase=rebase)
+
+def cell_data(v) -> Dict[str, Any]:
+    """CellData for updateCells; "" leaves the cell empty."""
+    if isinstance(v, bool):
+        return {"userEnteredValue": {"boolValue": v}}
+    if isinstance(v, (int, float)):
+        return {"userEnteredValue": {"numberValue": v}}
+    if v == "":
+        return {}
+    return {"userEnteredValue": {"stringValue": str(v)}}
+
+def safe_write_dfs_to_sheets(frames: List[Tuple[pd.DataFrame, str, List[str]]], rebase: bool = True) -> bool:
+    """Overwrite several sheets (df, sheet_title, headers) with one spreadsheets.batchUpdate request.
+
+    With rebase, changes made to the sheets by someone else since they were last read are kept.
+    """
+    requests = []
+    grown = []
+    written = {}
+    merged_titles = []
+    if rebase:
+        frames, merged_titles = rebase_on_remote(frames)
+    handles = get_gs_handles()
+    stale = [t for _, t, _ in frames if t in handles["stale_grid"]]
+    # Acá sí se necesita el tamaño real de la grilla: una llamada de metadatos refresca todos los handles
+    if stale and existing_sheet_titles() is None:
+        for t in stale:
+            handles["stale_grid"].discard(t)
+            handles["worksheets"].pop(t, None)
+    for df, sheet_title, headers in frames:
+        ws = safe_get_worksheet(sheet_title)
+        if ws is None:
+            log_warn(f"Cannot write to sheet {sheet_title} (ws None).")
+            return False
+        rows = sheet_rows_from_df(df, headers)
+        written[sheet_title] = rows
+        # updateCells no amplía la hoja: se agregan filas/columnas si el contenido no cabe
+        extra_rows = len(rows) - ws.row_count
+        extra_cols = len(headers) - ws.col_count
+        if extra_rows > 0:
+            requests.append({"appendDimension": {"sheetId": ws.id, "dimension": "ROWS", "length": extra_rows}})
+        if extra_cols > 0:
+            requests.append({"appendDimension": {"sheetId": ws.id, "dimension": "COLUMNS", "length": extra_cols}})
+        if extra_rows > 0 or extra_cols > 0:
+            grown.append(sheet_title)
+        # Rango sin límites = toda la hoja; las celdas que no cubren las filas nuevas quedan vacías
+        requests.append({"updateCells": {
+            "range": {"sheetId": ws.id},
+            "rows": [{"values": [cell_data(v) for v in r]} for r in rows],
+            "fields": "userEnteredValue",
+        }})
+    if not requests:
+        return True
+    titles = ", ".join(t for _, t, _ in frames)
+
+    for attempt in range(2):
         try:
-            ws.clear()
-            ws.update(rows, 'A1')
-            log_info(f"Wrote {len(df_to_write)} rows to Google Sheet {sheet_title} in a single batch update.")
+            acquire_write_token()
+            GS_SPREADSHEET.batch_update({"requests": requests})
+            for t, rows in written.items():
+                sheet_baselines()[t] = normalize_sheet_values(rows)
+            if merged_titles:
+                bump_after_write(*merged_titles)
+            mark_grid_stale(*grown)
+            log_info(f"Wrote sheets {titles} in a single batchUpdate request.")
             return True
         except Exception as e:
             msg = str(e)
-            if "Quota exceeded" in msg or "rateLimitExceeded" in msg or "[429]" in msg:
-                log_warn(f"Quota exceeded writing to {sheet_title}: attempt {attempt+1}")
-                exponential_backoff(attempt)
-                continue
+            if is_auth_error(msg) and attempt == 0:
+                reset_gs_handles()
+                if init_gs_client() and GS_SPREADSHEET is not None:
+                    continue
+            log_warn(f"Error writing sheets {titles}: {e}")
+            return False
+    log_warn(f"Failed to write sheets {titles} after retries.")
+    return False
+
+def safe_write_rows_by_key(frames: List[Tuple[pd.DataFrame, str, List[str], str, List[Any]]],
+                           appends: List[Tuple[List[Dict[str, Any]], str, List[str], pd.DataFrame]] = ()) -> bool:
+    """Write only the rows of the given keys (df, sheet_title, headers, key column, key values) in one batchUpdate.
+
+    Rows are located on the sheet's current contents, so rows edited meanwhile by someone else are left alone.
+    Existing rows of a key are updated in place, leftover ones deleted and new ones appended. If the rows
+    can't be located (empty sheet, different headers, read error) the whole sheets are rewritten instead.
+
+    appends are (rows, sheet_title, headers, full_df) for sheets that only grow: they go as appendCells in
+    the same batchUpdate when their header row is known or checks out in the pre-write read (row 1 only),
+    otherwise through safe_append_rows_to_sheet afterwards.
+    """
+    titles = [t for _, t, _, _, _ in frames]
+    direct, unchecked, separate = [], [], []
+    for a in appends:
+        (direct if cached_header_row(a[1]) == a[2] else unchecked).append(a)
+
+    def finish(ok: bool, pending_appends) -> bool:
+        for rows, t, headers, full_df in pending_appends:
+            ok = safe_append_rows_to_sheet(rows, t, headers, full_df=full_df) and ok
+        return ok
+
+    def full_rewrite(reason: str) -> bool:
+        log_warn(f"Row-scoped write to {titles} not possible ({reason}); rewriting whole sheets.")
+        ok = safe_write_dfs_to_sheets([(df, t, headers) for df, t, headers, _, _ in frames]) if frames else True
+        return finish(ok, appends)
+
+    current = []
+    if titles or unchecked:
+        # Las hojas de appends sin fila 1 conocida se verifican en esta misma lectura, así todo sale en un batchUpdate
+        ranges = [f"'{t}'" for t in titles] + [f"'{a[1]}'!1:1" for a in unchecked]
+        try:
+            acquire_write_token()
+            resp = GS_SPREADSHEET.values_batch_get(ranges, params=SHEETS_READ_PARAMS)
+            value_ranges = [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+        except Exception as e:
+            return full_rewrite(f"read failed: {e}")
+        current = value_ranges[:len(titles)]
+        for a, first in zip(unchecked, value_ranges[len(titles):]):
+            if first and [str(h) for h in first[0]] == a[2]:
+                get_gs_handles()["header_rows"][a[1]] = list(a[2])
+                direct.append(a)
             else:
-                log_warn(f"Error writing to sheet {sheet_title}: {e}")
-                return False
-    log_warn(f"Failed to write to sheet {sheet_title} after retries.")
+                separate.append(a)
+    all_titles = titles + [t for _, t, _, _ in direct]
+    worksheets = {}
+    for t in all_titles:
+        worksheets[t] = safe_get_worksheet(t)
+        if worksheets[t] is None:
+            log_warn(f"Cannot write to sheet {t} (ws None).")
+            return False
+
+    requests = []
+    results = {}
+    resized = []
+    for (df, t, headers, key_col, key_values), cur in zip(frames, current):
+        if not cur or [str(h) for h in cur[0][:len(headers)]] != headers:
+            return full_rewrite(f"unexpected header row in {t}")
+        ws = worksheets[t]
+        k = headers.index(key_col)
+        wanted = {normalize_cell(v) for v in key_values}
+        # Cada fila de la hoja se normaliza una sola vez: sirve para ubicar las claves y para las baselines
+        cur_norm = [normalize_row(r) for r in cur]
+        old_pos = [i for i, r in enumerate(cur_norm) if i > 0 and len(r) > k and r[k] in wanted]
+        new_rows = sheet_rows_from_df(df[df[key_col].map(normalize_cell).isin(wanted)], headers)[1:]
+        updated = list(cur_norm)
+        for pos, row in zip(old_pos, new_rows):
+            old = cur_norm[pos] + [""] * (len(headers) - len(cur_norm[pos]))
+            new = normalize_row(row)
+            changed = [j for j in range(len(headers)) if old[j] != (new[j] if j < len(new) else "")]
+            if not changed:
+                continue  # la fila ya tiene esos valores
+            # Solo el tramo de celdas que cambió (p. ej. el Stock de un ajuste de inventario)
+            c0, c1 = changed[0], changed[-1] + 1
+            requests.append({"updateCells": {
+                "range": {"sheetId": ws.id, "startRowIndex": pos, "endRowIndex": pos + 1,
+                          "startColumnIndex": c0, "endColumnIndex": c1},
+                "rows": [{"values": [cell_data(v) for v in row[c0:c1]]}],
+                "fields": "userEnteredValue",
+            }})
+            updated[pos] = new
+        # De abajo hacia arriba para que los índices pendientes sigan siendo válidos
+        for pos in sorted(old_pos[len(new_rows):], reverse=True):
+            requests.append({"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": pos, "endIndex": pos + 1}}})
+            del updated[pos]
+        extra = new_rows[len(old_pos):]
+        if extra:
+            requests.append({"appendCells": {
+                "sheetId": ws.id,
+                "rows": [{"values": [cell_data(v) for v in r]} for r in extra],
+                "fields": "userEnteredValue",
+            }})
+            updated.extend(map(normalize_row, extra))
+        if len(updated) != len(cur):
+            resized.append(t)
+        results[t] = ([r for r in cur_norm if r], [r for r in updated if r])
+    appended = {}
+    for rows, t, headers, _ in direct:
+        appended[t] = sheet_rows_from_df(pd.DataFrame(rows), headers)[1:]
+        requests.append({"appendCells": {
+            "sheetId": worksheets[t].id,
+            "rows": [{"values": [cell_data(v) for v in r]} for r in appended[t]],
+            "fields": "userEnteredValue",
+        }})
+        resized.append(t)
+    if not requests:
+        return finish(True, separate)
+
+    for attempt in range(2):
+        try:
+            acquire_write_token()
+            GS_SPREADSHEET.batch_update({"requests": requests})
+            baselines = sheet_baselines()
+            changed_elsewhere = [t for t, (before, _) in results.items() if baselines.get(t) not in (None, before)]
+            for t, (_, after) in results.items():
+                baselines[t] = after
+            for t, values in appended.items():
+                if baselines.get(t) is not None:
+                    baselines[t].extend(normalize_sheet_values(values))
+            if changed_elsewhere:
+                # La hoja traía cambios de otra instancia: la vista local se recarga
+                bump_after_write(*changed_elsewhere)
+            mark_grid_stale(*resized)
+            log_info(f"Wrote {len(requests)} row ranges to sheets {', '.join(all_titles)} in a single batchUpdate request.")
+            return finish(True, separate)
+        except Exception as e:
+            msg = str(e)
+            if is_auth_error(msg) and attempt == 0:
+                reset_gs_handles()
+                if init_gs_client() and GS_SPREADSHEET is not None:
+                    continue
+            log_warn(f"Error writing rows to sheets {all_titles}: {e}")
+            return finish(False, direct + separate)
+    log_warn(f"Failed to write rows to sheets {all_titles} after retries.")
+    return finish(False, direct + separate)
+
+def safe_append_rows_to_sheet(rows: List[Dict[str, Any]], sheet_title: str, headers: List[str], full_df: pd.DataFrame = None) -> bool:
+    """Append only the new rows to the Google Sheet in a single values.append request.
+
+    If the sheet had no valid header row (new or empty sheet) and full_df is given,
+    the whole table is written instead so the sheet doesn't end up holding only the new rows.
+    """
+    ws = None
+    if cached_header_row(sheet_title) != headers or GS_SPREADSHEET is None:
+        ws = safe_get_worksheet(sheet_title)
+        if ws is None:
+            log_warn(f"Cannot append to sheet {sheet_title} (ws None).")
+            return False
+        if not ensure_sheet_headers(ws, headers, cached_header_row(sheet_title), fix=full_df is None) and full_df is not None:
+            # Hoja recién creada o sin headers: se escribe completa, no hay nada ajeno que conservar
+            return safe_write_df_to_sheet(full_df, sheet_title, headers, rebase=False)
+    values = sheet_rows_from_df(pd.DataFrame(rows), headers)[1:]
+
+    for attempt in range(2):
+        try:
+            acquire_write_token()
+            if ws is None:
+                # Headers ya conocidos: values.append directo sobre el spreadsheet, sin pedir la hoja
+                GS_SPREADSHEET.values_append(f"'{sheet_title}'!A1",
+                                             params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+                                             body={"values": values})
+            else:
+                ws.append_rows(values, value_input_option="RAW", insert_data_option="INSERT_ROWS")
+            baseline = sheet_baselines().get(sheet_title)
+            if baseline is not None:
+                baseline.extend(normalize_sheet_values(values))
+            mark_grid_stale(sheet_title)
+            log_info(f"Appended {len(values)} rows to Google Sheet {sheet_title} in a single request.")
+            return True
+        except Exception as e:
+            msg = str(e)
+            if is_auth_error(msg) and attempt == 0:
+                ws = reopen_worksheet(sheet_title)
+                if ws is not None:
+                    continue
+            log_warn(f"Error appending to sheet {sheet_title}: {e}")
+            return False
+    log_warn(f"Failed to append to sheet {sheet_title} after retries.")
     return False
 
+@st.cache_resource(show_spinner=False)
+def sheets_writer() -> Dict[str, Any]:
+    """Hilo único de escritura a Sheets (orden FIFO) + última tarea encolada por hoja."""
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets-writer")
+    atexit.register(pool.shutdown, wait=True)
+    return {"pool": pool, "lock": threading.Lock(), "pending": {}, "latest_full": {}, "local": threading.local()}
+
+@st.cache_resource(show_spinner=False)
+def sheets_write_quota() -> Dict[str, Any]:
+    """Balde de fichas de escritura, compartido por el proceso (el cupo es de la cuenta de servicio, no de la sesión)."""
+    return {"tokens": float(SHEETS_WRITES_PER_MINUTE), "stamp": time.time(), "lock": threading.Lock()}
+
+def acquire_write_token():
+    """Toma una ficha justo antes de cada request a Sheets del camino de escritura (lectura previa, batchUpdate,
+    append); si no hay, espera lo justo en vez de gastar un request en un 429.
+
+    Casi siempre la llama el hilo de escritura, así que esperar aquí no frena la interfaz.
+    """
+    quota = sheets_write_quota()
+    rate = SHEETS_WRITES_PER_MINUTE / 60.0
+    while True:
+        with quota["lock"]:
+            now = time.time()
+            quota["tokens"] = min(float(SHEETS_WRITES_PER_MINUTE), quota["tokens"] + (now - quota["stamp"]) * rate)
+            quota["stamp"] = now
+            if quota["tokens"] >= 1:
+                quota["tokens"] -= 1
+                return
+            wait_s = (1 - quota["tokens"]) / rate
+        time.sleep(wait_s)
+
+def schedule_sheet_write(sheet_titles: List[str], fn, *args, **kwargs):
+    """Encola una escritura best-effort a Sheets y vuelve enseguida; el CSV local ya debe estar guardado.
+
+    Los DataFrames pasados no se deben modificar después. Una reescritura completa
+    (safe_write_df_to_sheet) que no ha arrancado se descarta si detrás viene otra de la misma hoja.
+    """
+    if GS_CLIENT is None:
+        return None
+    writer = sheets_writer()
+    token = object()
+    full_rewrite = fn is safe_write_df_to_sheet
+    bumps: List[str] = []
+
+    def job():
+        writer["local"].bumps = bumps
+        try:
+            if full_rewrite:
+                with writer["lock"]:
+                    if writer["latest_full"].get(sheet_titles[0]) is not token:
+                        log_info(f"Skipped superseded write to sheet {sheet_titles[0]}.")
+                        return
+            fn(*args, **kwargs)
+        except Exception as e:
+            log_warn(f"Background sync to sheets {sheet_titles} failed: {e}")
+        finally:
+            writer["local"].bumps = None
+            # Una lectura tomada mientras la escritura estaba en curso ya no sirve
+            for t in sheet_titles:
+                sheet_snapshots().pop(t, None)
+
+    def bump_when_done(_fut):
+        # Con la tarea ya terminada, load_df vuelve a leer la hoja (con las filas remotas fusionadas) y no el CSV local
+        if bumps:
+            bump_sheet_version(*bumps)
+
+    with writer["lock"]:
+        if full_rewrite:
+            writer["latest_full"][sheet_titles[0]] = token
+        fut = writer["pool"].submit(job)
+        for t in sheet_titles:
+            writer["pending"][t] = fut
+    fut.add_done_callback(bump_when_done)
+    return fut
+
+def bump_after_write(*sheet_titles: str):
+    """Invalida hojas cuya escritura fusionó cambios de otra instancia.
+
+    Desde el hilo de escritura se aplaza hasta que la tarea termina: mientras sigue pendiente, load_df lee
+    el CSV local (sin las filas remotas fusionadas) y lo guardaría en caché con la versión nueva.
+    """
+    deferred = getattr(sheets_writer()["local"], "bumps", None)
+    if deferred is None:
+        bump_sheet_version(*sheet_titles)
+    else:
+        deferred.extend(sheet_titles)
+
+def has_pending_sheet_write(sheet_title: str) -> bool:
+    writer = sheets_writer()
+    with writer["lock"]:
+        fut = writer["pending"].get(sheet_title)
+    return fut is not None and not fut.done()
+
+def pending_sheet_writes() -> List[str]:
+    """Hojas con escrituras aún en cola o en curso; las terminadas se retiran del registro."""
+    writer = sheets_writer()
+    with writer["lock"]:
+        for t in [t for t, fut in writer["pending"].items() if fut.done()]:
+            del writer["pending"][t]
+        return sorted(writer["pending"])
+
+def wait_for_sheet_writes(timeout: float = 60):
+    """Espera a que terminen las escrituras encoladas (p.ej. antes de una sincronización completa)."""
+    writer = sheets_writer()
+    with writer["lock"]:
+        futures = list(writer["pending"].values())
+    wait(futures, timeout=timeout)
+
 # ---------------------------
 # LOCAL CSV helpers (single source of truth when offline)
 # ---------------------------
@@ -356,6 +1179,32 @@ def save_local_csv(path: Path, df: pd.DataFrame, headers: List[str]):
         log_error(f"Error saving local CSV {path}: {e}")
         return False
 
+def append_local_csv(path: Path, rows: List[Dict[str, Any]], headers: List[str], full_df: pd.DataFrame):
+    """Agrega solo las filas nuevas al final del CSV, sin reescribirlo.
+
+    Si el archivo no está en sincronía con full_df (tabla completa ya con las filas nuevas): otras
+    columnas, otra cantidad de filas o sin salto de línea final, se guarda full_df completo.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.readline()
+            lines = 1 + sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 16), b""))
+            f.seek(-1, os.SEEK_END)
+            ends_with_newline = f.read(1) == b"\n"
+        in_sync = (head.decode("utf-8").strip() == ",".join(headers) and ends_with_newline
+                   and lines - 1 == len(full_df) - len(rows))
+    except (OSError, UnicodeDecodeError):
+        in_sync = False
+    if not in_sync:
+        return save_local_csv(path, full_df, headers)
+    try:
+        pd.DataFrame(rows).reindex(columns=headers).to_csv(path, mode="a", header=False, index=False)
+        log_info(f"Appended {len(rows)} rows to local CSV {path}.")
+        return True
+    except Exception as e:
+        log_error(f"Error appending to local CSV {path}: {e}")
+        return save_local_csv(path, full_df, headers)
+
 def load_local_csv_by_sheet(sheet_title: str) -> pd.DataFrame:
     if sheet_title == "Clientes":
         return load_local_csv(CSV_CLIENTES, HEAD_CLIENTES)
@@ -393,12 +1242,105 @@ def save_local_csv_by_sheet(sheet_title: str, df: pd.DataFrame):
         log_warn(f"Unknown sheet title for saving local CSV: {sheet_title}")
         return False
 
+def append_local_csv_by_sheet(sheet_title: str, rows: List[Dict[str, Any]], full_df: pd.DataFrame):
+    mapping = {
+        "Pedidos": (CSV_PEDIDOS, HEAD_PEDIDOS),
+        "Pedidos_detalle": (CSV_PEDIDOS_DETALLE, HEAD_PEDIDOS_DETALLE),
+        "FlujoCaja": (CSV_FLUJO, HEAD_FLUJO),
+        "Gastos": (CSV_GASTOS, HEAD_GASTOS),
+    }
+    if sheet_title not in mapping:
+        return save_local_csv_by_sheet(sheet_title, full_df)
+    path, headers = mapping[sheet_title]
+    return append_local_csv(path, rows, headers, full_df)
+
 # ---------------------------
 # HIGH-LEVEL DATA LOAD/STORE (cache to reduce FS/Sheets calls)
 # ---------------------------
 
-@st.cache_data(ttl=30, show_spinner=False)
-def load_df(sheet_title: str) -> pd.DataFrame:
+@st.cache_resource(show_spinner=False)
+def sheet_versions() -> Dict[str, int]:
+    """Contador de escrituras por hoja, compartido entre sesiones; forma parte de la clave de caché de load_df."""
+    return {}
+
+def bump_sheet_version(*sheet_titles: str):
+    """Invalida solo las hojas modificadas; el resto sigue saliendo de caché."""
+    versions = sheet_versions()
+    for title in sheet_titles:
+        versions[title] = versions.get(title, 0) + 1
+
+@st.cache_resource(show_spinner=False)
+def written_frames() -> Dict[str, Tuple[int, float, pd.DataFrame]]:
+    """Última tabla guardada por la app en cada hoja: (versión, momento, df). Compartida entre sesiones."""
+    return {}
+
+def publish_frames(frames: Dict[str, pd.DataFrame]):
+    """Sube la versión de las hojas guardadas y deja su contenido nuevo como caché de esa versión,
+    así el siguiente rerun no vuelve a pedir a Sheets lo que se acaba de escribir."""
+    bump_sheet_version(*frames)
+    versions = sheet_versions()
+    store = written_frames()
+    now = time.time()
+    for title, df in frames.items():
+        typed = coerce_numeric(df.copy(), NUMERIC_COLUMNS.get(title, []), INTEGER_COLUMNS.get(title, []))
+        store[title] = (versions[title], now, typed)
+
+def load_df(sheet_title: str, copy: bool = True) -> pd.DataFrame:
+    """Tabla de la hoja. Se guarda por sesión (misma versión y TTL que la caché) para no deserializarla en cada llamada.
+
+    copy=False devuelve el objeto guardado: solo para lecturas que no modifican la tabla.
+    """
+    version = sheet_versions().get(sheet_title, 0)
+    frames = st.session_state.setdefault("sheet_frames", {})
+    hit = frames.get(sheet_title)
+    if hit is None or hit[0] != version or time.time() - hit[1] >= SHEETS_CACHE_TTL:
+        written = written_frames().get(sheet_title)
+        if written is not None and written[0] == version and time.time() - written[1] < SHEETS_CACHE_TTL:
+            hit = written
+        else:
+            prefetch = st.session_state.get("prefetch_sheets", BATCH_SHEETS)
+            hit = (version, time.time(), _load_df_cached(sheet_title, version, prefetch))
+        frames[sheet_title] = hit
+    return hit[2].copy() if copy else hit[2]
+
+def coerce_numeric(df: pd.DataFrame, cols: List[str], int_cols: List[str] = ()) -> pd.DataFrame:
+    """Convierte las columnas presentes a numérico (inválido/vacío -> 0) en una sola asignación; int_cols quedan int64."""
+    present = [c for c in dict.fromkeys(list(cols) + list(int_cols)) if c in df.columns]
+    converted = {}
+    for c in present:
+        # Las lecturas sin formato ya traen números: esas columnas solo necesitan rellenar vacíos, si los hay
+        col = df[c]
+        numeric = pd.api.types.is_numeric_dtype(col)
+        if not numeric:
+            col = pd.to_numeric(col, errors="coerce")
+        if col.hasnans:
+            converted[c] = col.fillna(0)
+        elif not numeric:
+            converted[c] = col
+    if converted:
+        df[list(converted)] = pd.DataFrame(converted, index=df.index)
+    ints = [c for c in int_cols if c in df.columns]
+    if ints:
+        df = df.astype({c: "int64" for c in ints})
+    return df
+
+def df_fingerprint(df: pd.DataFrame) -> int:
+    """Huella del contenido (independiente del orden de filas) para saltar guardados que no cambian nada."""
+    return int(pd.util.hash_pandas_object(df.astype(str), index=False).sum())
+
+@st.cache_resource(ttl=SHEETS_CACHE_TTL, max_entries=32, show_spinner=False)
+def _load_df_cached(sheet_title: str, version: int, _prefetch: Sequence[str] = BATCH_SHEETS) -> pd.DataFrame:
+    """Tabla tipada, compartida sin copiar (cache_resource no serializa): nunca se modifica, load_df entrega copias.
+
+    _prefetch (hojas a refrescar en el mismo batchGet) no forma parte de la clave de la caché.
+    """
+    df = read_sheet_or_local(sheet_title, _prefetch)
+    if sheet_title == "Inventario":
+        # Nombres canónicos una sola vez al cargar: las altas/ediciones de pedidos suman deltas sin recorrer nombres
+        return canonical_inventory(df)
+    return coerce_numeric(df, NUMERIC_COLUMNS.get(sheet_title, []), INTEGER_COLUMNS.get(sheet_title, []))
+
+def read_sheet_or_local(sheet_title: str, prefetch: Sequence[str] = BATCH_SHEETS) -> pd.DataFrame:
     mapping = {
         "Clientes": (safe_read_sheet_to_df, HEAD_CLIENTES),
         "Pedidos": (safe_read_sheet_to_df, HEAD_PEDIDOS),
@@ -410,9 +1352,12 @@ def load_df(sheet_title: str) -> pd.DataFrame:
     }
     if sheet_title not in mapping:
         return pd.DataFrame()
+    if has_pending_sheet_write(sheet_title):
+        # La última escritura aún se está subiendo: el CSV local ya tiene el estado nuevo
+        return load_local_csv_by_sheet(sheet_title)
     func, headers = mapping[sheet_title]
     try:
-        df = func(sheet_title, headers)
+        df = func(sheet_title, headers, prefetch)
         if df is None or df.empty:
             df_local = load_local_csv_by_sheet(sheet_title)
             return df_local
@@ -427,58 +1372,143 @@ def load_df(sheet_title: str) -> pd.DataFrame:
 
 def flush_cache():
     st.cache_data.clear()
+    _load_df_cached.clear()
+    sheet_snapshots().clear()
+    written_frames().clear()
+    order_details_index.clear()
+    product_name_keys.clear()
+    _client_names.clear()
+    _order_rows.clear()
+    clients_arrow_table.clear()
+    st.session_state.pop("sheet_frames", None)
+    st.session_state.pop("week_positions", None)
     log_info("Cleared st.cache_data")
 
+@st.cache_resource(ttl=SHEETS_CACHE_TTL, max_entries=16, show_spinner=False,
+                   hash_funcs={pd.DataFrame: lambda d: (tuple(d.columns), tuple(d.index))})
+def clients_arrow_table(df: pd.DataFrame, version: int) -> pa.Table:
+    """Tabla Arrow de clientes para st.dataframe, compartida sin serializar (es inmutable).
+
+    La clave son la versión de Clientes y las filas mostradas.
+    """
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Columnas mixtas (p.ej. teléfonos numéricos y texto desde Sheets): se muestran como texto
+        obj_cols = df.select_dtypes(include="object").columns
+        return pa.Table.from_pandas(df.astype({c: str for c in obj_cols}), preserve_index=False)
+
 # ---------------------------
 # BUSINESS LOGIC: CRUD Orders, Inventory adjustments, Payments, Flow
 # ---------------------------
 
+# Separadores que se ignoran al comparar nombres de producto ("Arandanos 125g" == "arandanos_125g")
+_NAME_SEPARATORS_RE = re.compile(r"[ _-]")
+
+@st.cache_resource(show_spinner=False, ttl=SHEETS_CACHE_TTL, max_entries=4)
+def product_name_keys(version: int) -> Tuple[frozenset, Dict[str, str], Optional[re.Pattern], str, Dict[str, str]]:
+    """Nombres de Productos, el mapa clave normalizada -> primer nombre, las coincidencias parciales
+    ya preparadas (regex de claves y claves unidas en un solo texto) y un memo nombre recibido -> canónico
+    que se llena con el uso (vive lo mismo que esta versión)."""
+    names = load_df("Productos", copy=False)["Nombre"].dropna().astype(str)
+    keys = names.str.lower().str.replace(_NAME_SEPARATORS_RE, "", regex=True)
+    by_key = {}
+    for k, n in zip(keys.tolist(), names.tolist()):
+        by_key.setdefault(k, n)
+    # Una sola búsqueda en C por dirección en vez de comparar clave por clave en Python
+    contained = sorted((k for k in by_key if k), key=len, reverse=True)  # la clave más larga gana en cada posición
+    key_re = re.compile("|".join(map(re.escape, contained))) if contained else None
+    return frozenset(names), by_key, key_re, "\x00".join(by_key), {}
+
 def canonical_product_name(name: str) -> str:
     if not isinstance(name, str):
         return name
+    names, by_key, key_re, joined_keys, memo = product_name_keys(sheet_versions().get("Productos", 0))
+    hit = memo.get(name)
+    if hit is not None:
+        return hit
     s = name.strip()
-    df_prod = load_df("Productos")
-    if df_prod.empty:
-        return s
-    if s in df_prod["Nombre"].values:
-        return s
-    def norm(x): return x.lower().replace(" ", "").replace("_","").replace("-","")
-    ns = norm(s)
-    for k in df_prod["Nombre"]:
-        if norm(k) == ns:
-            return k
-    for k in df_prod["Nombre"]:
-        if ns in norm(k) or norm(k) in ns:
-            return k
+    if names and s not in names:
+        ns = _NAME_SEPARATORS_RE.sub("", s.lower())
+        if ns in by_key:
+            s = by_key[ns]
+        else:
+            # Última opción: coincidencia parcial, una clave dentro del nombre o el nombre dentro de una clave
+            # (solo la primera vez por nombre, luego sale del memo)
+            m = key_re.search(ns) if key_re is not None else None
+            if m is not None:
+                s = by_key[m.group(0)]
+            elif by_key:
+                pos = joined_keys.find(ns)
+                if pos >= 0:
+                    start = joined_keys.rfind("\x00", 0, pos) + 1
+                    end = joined_keys.find("\x00", pos)
+                    s = by_key[joined_keys[start:end if end >= 0 else len(joined_keys)]]
+    memo[name] = s
     return s
 
-def next_id_for(df: pd.DataFrame, col: str) -> int:
-    if df is None or df.empty or col not in df.columns:
-        return 1
-    try:
-        vals = pd.to_numeric(df[col], errors='coerce').dropna().astype(int).tolist()
-        return max(vals) + 1 if vals else 1
-    except Exception:
-        return len(df) + 1
+def canonical_product_names(nombres: pd.Series) -> pd.Series:
+    """canonical_product_name sobre una columna: una llamada por nombre distinto y un map en C para las filas."""
+    nombres = nombres.astype(str)
+    return nombres.map({n: canonical_product_name(n) for n in nombres.unique()})
+
+@st.cache_resource(show_spinner=False)
+def id_counters() -> Tuple[threading.Lock, Dict[str, int]]:
+    """Último ID entregado por columna, compartido entre sesiones: dos altas seguidas nunca repiten ID."""
+    return threading.Lock(), {}
 
+def next_id_for(df: pd.DataFrame, col: str) -> int:
+    df_max = 0
+    if df is not None and not df.empty and col in df.columns:
+        ids = df[col]
+        # Las columnas de ID llegan int64 desde load_df: reducción directa, sin convertir la columna en cada alta
+        if not pd.api.types.is_numeric_dtype(ids):
+            ids = pd.to_numeric(ids, errors='coerce')
+        max_val = ids.max()
+        df_max = 0 if pd.isna(max_val) else int(max_val)
+    lock, counters = id_counters()
+    with lock:
+        # El máximo de la tabla cubre filas agregadas por fuera de esta instancia
+        new_id = max(df_max, counters.get(col, 0)) + 1
+        counters[col] = new_id
+    return new_id
+
+@st.cache_resource(show_spinner=False)
+def data_write_lock() -> threading.RLock:
+    """Un solo escritor a la vez entre sesiones: cada alta/edición lee, modifica y publica sin que otra se intercale."""
+    return threading.RLock()
+
+def serialized_write(func):
+    """Ejecuta la función de escritura bajo data_write_lock(); las lecturas (load_df, tablas) no lo toman."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with data_write_lock():
+            return func(*args, **kwargs)
+    return wrapper
+
+@serialized_write
 def create_client(nombre: str, tipo_doc: str, num_doc: str, telefono: str="", direccion: str="") -> int:
-    dfc = load_df("Clientes")
+    # Las altas no modifican la tabla cargada: el concat ya arma una nueva, así que no se copia antes
+    dfc = load_df("Clientes", copy=False)
     cid = next_id_for(dfc, "ID Cliente")
     new_row = {"ID Cliente": cid, "Nombre": nombre, "Tipo Documento": tipo_doc, "Numero Documento": num_doc, "Telefono": telefono, "Direccion": direccion}
     dfc = pd.concat([dfc, pd.DataFrame([new_row])], ignore_index=True)
     dfc = dfc.sort_values(by='Nombre').reset_index(drop=True)
     save_local_csv_by_sheet("Clientes", dfc)
-    safe_write_df_to_sheet(dfc, "Clientes", HEAD_CLIENTES)
-    flush_cache()
+    schedule_sheet_write(["Clientes"], safe_append_rows_to_sheet, [new_row], "Clientes", HEAD_CLIENTES, full_df=dfc)
+    publish_frames({"Clientes": dfc})
+    clients_arrow_table.clear()
     log_info(f"Cliente creado: {cid} - {nombre}")
     return cid
 
+@serialized_write
 def edit_client(client_id: int, nombre: str, tipo_doc: str, num_doc: str, telefono: str="", direccion: str=""):
     dfc = load_df("Clientes")
-    if dfc.empty or client_id not in dfc["ID Cliente"].astype(int).tolist():
+    if dfc.empty or not (dfc["ID Cliente"] == client_id).any():
         raise ValueError("ID cliente no encontrado para editar")
     
-    idx = dfc.index[dfc["ID Cliente"].astype(int) == int(client_id)][0]
+    idx = dfc.index[dfc["ID Cliente"] == int(client_id)][0]
+    before = df_fingerprint(dfc)
     
     dfc.at[idx, "Nombre"] = nombre
     dfc.at[idx, "Tipo Documento"] = tipo_doc
@@ -487,86 +1517,151 @@ def edit_client(client_id: int, nombre: str, tipo_doc: str, num_doc: str, telefo
     dfc.at[idx, "Direccion"] = direccion
     
     dfc = dfc.sort_values(by='Nombre').reset_index(drop=True)
+    if df_fingerprint(dfc) == before:
+        log_info(f"Cliente {client_id} sin cambios; no se guarda.")
+        return
     
     save_local_csv_by_sheet("Clientes", dfc)
     try:
-        safe_write_df_to_sheet(dfc, "Clientes", HEAD_CLIENTES)
+        schedule_sheet_write(["Clientes"], safe_write_df_to_sheet, dfc, "Clientes", HEAD_CLIENTES)
     except Exception as e:
         log_warn(f"Best-effort sync failed on edit_client {client_id}: {e}")
     
-    flush_cache()
+    publish_frames({"Clientes": dfc})
+    clients_arrow_table.clear()
     log_info(f"Cliente actualizado: {client_id} - {nombre}")
 
+@serialized_write
 def create_product(nombre: str, precio: float, costo: float) -> int:
-    dfp = load_df("Productos")
+    dfp = load_df("Productos", copy=False)
     pid = next_id_for(dfp, "ID Producto")
     new_row = {"ID Producto": pid, "Nombre": nombre, "Precio": precio, "Costo": costo}
     dfp = pd.concat([dfp, pd.DataFrame([new_row])], ignore_index=True)
     dfp = dfp.sort_values(by='Nombre').reset_index(drop=True)
     save_local_csv_by_sheet("Productos", dfp)
-    safe_write_df_to_sheet(dfp, "Productos", HEAD_PRODUCTOS)
-    flush_cache()
+    schedule_sheet_write(["Productos"], safe_write_df_to_sheet, dfp, "Productos", HEAD_PRODUCTOS)
+    publish_frames({"Productos": dfp})
     log_info(f"Producto creado: {pid} - {nombre}")
     return pid
 
+@serialized_write
 def edit_product(product_id: int, nombre: str, precio: float, costo: float):
     dfp = load_df("Productos")
-    if dfp.empty or product_id not in dfp["ID Producto"].astype(int).tolist():
+    if dfp.empty or not (dfp["ID Producto"] == product_id).any():
         raise ValueError("ID producto no encontrado para editar")
     
-    idx = dfp.index[dfp["ID Producto"].astype(int) == int(product_id)][0]
+    idx = dfp.index[dfp["ID Producto"] == int(product_id)][0]
+    before = df_fingerprint(dfp)
     dfp.at[idx, "Nombre"] = nombre
     dfp.at[idx, "Precio"] = precio
     dfp.at[idx, "Costo"] = costo
     
     dfp = dfp.sort_values(by='Nombre').reset_index(drop=True)
+    if df_fingerprint(dfp) == before:
+        log_info(f"Producto {product_id} sin cambios; no se guarda.")
+        return
     
     save_local_csv_by_sheet("Productos", dfp)
     try:
-        safe_write_df_to_sheet(dfp, "Productos", HEAD_PRODUCTOS)
+        schedule_sheet_write(["Productos"], safe_write_df_to_sheet, dfp, "Productos", HEAD_PRODUCTOS)
     except Exception as e:
         log_warn(f"Best-effort sync failed on edit_product {product_id}: {e}")
     
-    flush_cache()
+    publish_frames({"Productos": dfp})
     log_info(f"Producto actualizado: {product_id} - {nombre}")
 
+@serialized_write
 def delete_product(product_id: int):
     dfp = load_df("Productos")
-    if dfp.empty or product_id not in dfp["ID Producto"].astype(int).tolist():
+    if dfp.empty or not (dfp["ID Producto"] == product_id).any():
         raise ValueError("ID producto no encontrado para eliminar")
     
-    dfp = dfp[dfp["ID Producto"].astype(int) != int(product_id)].reset_index(drop=True)
+    dfp = dfp[dfp["ID Producto"] != int(product_id)].reset_index(drop=True)
     
     save_local_csv_by_sheet("Productos", dfp)
     try:
-        safe_write_df_to_sheet(dfp, "Productos", HEAD_PRODUCTOS)
+        schedule_sheet_write(["Productos"], safe_write_df_to_sheet, dfp, "Productos", HEAD_PRODUCTOS)
     except Exception as e:
         log_warn(f"Best-effort sync failed on delete_product {product_id}: {e}")
     
-    flush_cache()
+    publish_frames({"Productos": dfp})
     log_info(f"Producto eliminado: {product_id}")
 
+def canonical_inventory(df_inv: pd.DataFrame) -> pd.DataFrame:
+    """Inventario con nombres canónicos y una fila por producto (stock sumado), ordenado por producto."""
+    if df_inv is None or df_inv.empty:
+        return pd.DataFrame({"Producto": pd.Series(dtype=object), "Stock": pd.Series(dtype="int64")})
+    nombres = df_inv["Producto"].astype(str)
+    canonicos = canonical_product_names(nombres)
+    stock = pd.to_numeric(df_inv["Stock"], errors="coerce").fillna(0).astype(int)
+    if nombres.is_unique and canonicos.equals(nombres):
+        # Caso normal (la app siempre guarda una fila por nombre canónico): basta ordenar, sin agrupar
+        return (pd.DataFrame({"Producto": nombres.to_numpy(), "Stock": stock.to_numpy()})
+                .sort_values("Producto", ignore_index=True))
+    return stock.groupby(canonicos).sum().rename_axis("Producto").rename("Stock").reset_index()
+
+def apply_inventory_delta(df_inv: pd.DataFrame, deltas: Dict[str, int]) -> pd.DataFrame:
+    """Suma los deltas de stock (producto canónico -> cantidad) a un inventario canónico, como el de load_df."""
+    stock = df_inv.set_index("Producto")["Stock"]
+    stock = stock.add(pd.Series(deltas, dtype="int64"), fill_value=0).astype(int).sort_index()
+    return stock.rename_axis("Producto").rename("Stock").reset_index()
+
+def product_prices(df_prod: pd.DataFrame) -> Dict[str, Any]:
+    """Precio por nombre de producto (el primero si hay repetidos): cada línea se busca en un dict, sin recorrer la tabla."""
+    if df_prod is None or df_prod.empty:
+        return {}
+    unicos = df_prod.drop_duplicates("Nombre")
+    return dict(zip(unicos["Nombre"], unicos["Precio"]))
+
+def returned_stock(lines: pd.DataFrame) -> Dict[str, int]:
+    """Unidades de las líneas de un pedido por producto canónico: lo que vuelve al inventario al editarlo o eliminarlo."""
+    if lines.empty:
+        return {}
+    cantidades = pd.to_numeric(lines["Cantidad"], errors="coerce").fillna(0).astype(int)
+    por_producto = cantidades.groupby(canonical_product_names(lines["Producto"]), sort=False).sum()
+    return {p: int(q) for p, q in por_producto.items() if q}
+
+def persist_row_changes(frames: List[Tuple[pd.DataFrame, str, List[str], str, List[Any]]],
+                        appends: List[Tuple[List[Dict[str, Any]], str, List[str], pd.DataFrame]] = (),
+                        context: str = "") -> None:
+    """Guarda de una sola vez tablas ya calculadas: CSV local, una tarea de escritura a Sheets
+    (un solo batchUpdate con las filas por clave y los appends) y la caché publicada.
+
+    frames y appends tienen el formato de safe_write_rows_by_key; nada se guarda antes de terminar los cálculos.
+    """
+    for df, title, _, _, _ in frames:
+        save_local_csv_by_sheet(title, df)
+    for rows, title, _, full_df in appends:
+        append_local_csv_by_sheet(title, rows, full_df)
+    try:
+        schedule_sheet_write([f[1] for f in frames] + [a[1] for a in appends], safe_write_rows_by_key,
+                             list(frames), appends=list(appends))
+    except Exception as e:
+        log_warn(f"Best-effort sync failed on {context}: {e}")
+    publish_frames({**{f[1]: f[0] for f in frames}, **{a[1]: a[3] for a in appends}})
+
+@serialized_write
 def create_order_with_details(cliente_id: int, items: Dict[str,int], domicilio_bool: bool=False, fecha_entrega: date=None, descuento: float=0) -> int:
-    dfc = load_df("Clientes")
-    if dfc.empty or cliente_id not in dfc["ID Cliente"].astype(int).tolist():
+    cliente_nombre = client_names().get(int(cliente_id))
+    if cliente_nombre is None:
         raise ValueError("ID cliente no encontrado")
-    cliente_nombre = dfc.loc[dfc["ID Cliente"].astype(int) == int(cliente_id), "Nombre"].values[0]
 
-    df_ped = load_df("Pedidos")
-    df_det = load_df("Pedidos_detalle")
-    df_inv = load_df("Inventario")
-    df_prod = load_df("Productos")
+    # Pedido y detalle se extienden con concat y el inventario sale de apply_inventory_delta: todas tablas nuevas
+    df_ped = load_df("Pedidos", copy=False)
+    df_det = load_df("Pedidos_detalle", copy=False)
+    df_inv = load_df("Inventario", copy=False)
+    df_prod = load_df("Productos", copy=False)
+    precios = product_prices(df_prod)
 
-    subtotal = 0
-    for p,q in items.items():
-        prod = canonical_product_name(p)
-        price = df_prod.loc[df_prod["Nombre"] == prod, "Precio"].values[0] if not df_prod.empty and prod in df_prod["Nombre"].values else 0
-        subtotal += price * int(q)
+    # Cada ítem se normaliza una sola vez; el subtotal y las líneas de detalle salen de la misma lista
+    lineas = [(canonical_product_name(p), int(q)) for p, q in items.items()]
+    subtotal = sum(precios.get(prod, 0) * qty for prod, qty in lineas)
 
     domicilio_monto = DOMICILIO_COST if domicilio_bool else 0
     total = (subtotal + domicilio_monto) - descuento
-    fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    semana_entrega = int(pd.to_datetime(fecha_entrega).isocalendar().week) if fecha_entrega else datetime.now().isocalendar().week
+    ahora = datetime.now()
+    fecha_actual = ahora.strftime("%Y-%m-%d %H:%M:%S")
+    semana_entrega = int((pd.Timestamp(fecha_entrega) if fecha_entrega else ahora).isocalendar()[1])
 
     pid = next_id_for(df_ped, "ID Pedido")
     header_row = {
@@ -576,81 +1671,123 @@ def create_order_with_details(cliente_id: int, items: Dict[str,int], domicilio_b
     }
     df_ped = pd.concat([df_ped, pd.DataFrame([header_row])], ignore_index=True)
 
-    for prod_raw, qty in items.items():
-        prod = canonical_product_name(prod_raw)
-        price = df_prod.loc[df_prod["Nombre"] == prod, "Precio"].values[0] if not df_prod.empty and prod in df_prod["Nombre"].values else 0
-        subtotal_line = int(qty) * int(price)
-        line = {"ID Pedido": pid, "Producto": prod, "Cantidad": int(qty), "Precio_unitario": int(price), "Subtotal": subtotal_line}
-        df_det = pd.concat([df_det, pd.DataFrame([line])], ignore_index=True)
-
-        if df_inv is None or df_inv.empty:
-            df_inv = pd.DataFrame([[prod, -int(qty)]], columns=HEAD_INVENTARIO)
-        else:
-            df_inv["Producto"] = df_inv["Producto"].astype(str).apply(lambda x: canonical_product_name(x))
-            if prod in df_inv["Producto"].values:
-                idx = df_inv.index[df_inv["Producto"] == prod][0]
-                df_inv.at[idx, "Stock"] = int(df_inv.at[idx, "Stock"]) - int(qty)
-            else:
-                df_inv = pd.concat([df_inv, pd.DataFrame([[prod, -int(qty)]], columns=HEAD_INVENTARIO)], ignore_index=True)
-
-    df_inv["Producto"] = df_inv["Producto"].astype(str).apply(lambda x: canonical_product_name(x))
-    df_inv = df_inv.groupby("Producto", as_index=False).agg({"Stock":"sum"})
-
-    save_local_csv_by_sheet("Pedidos", df_ped)
-    save_local_csv_by_sheet("Pedidos_detalle", df_det)
-    save_local_csv_by_sheet("Inventario", df_inv)
-    
-    try:
-        safe_write_df_to_sheet(df_ped, "Pedidos", HEAD_PEDIDOS)
-        safe_write_df_to_sheet(df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE)
-        safe_write_df_to_sheet(df_inv, "Inventario", HEAD_INVENTARIO)
-    except Exception as e:
-        log_warn(f"Best-effort sync to sheets failed for new order {pid}: {e}")
-
-    flush_cache()
+    # Filas nuevas acumuladas en listas: un solo concat al final en vez de uno por línea
+    detalle_rows = []
+    inv_delta: Dict[str, int] = {}
+    for prod, qty in lineas:
+        price = precios.get(prod, 0)
+        subtotal_line = qty * int(price)
+        line = {"ID Pedido": pid, "Producto": prod, "Cantidad": qty, "Precio_unitario": int(price), "Subtotal": subtotal_line}
+        detalle_rows.append(line)
+        inv_delta[prod] = inv_delta.get(prod, 0) - qty
+
+    df_det = pd.concat([df_det, pd.DataFrame(detalle_rows, columns=HEAD_PEDIDOS_DETALLE)], ignore_index=True)
+    # Líneas con cantidad 0 no mueven stock: sin delta no se lee ni se escribe el inventario
+    inv_delta = {p: d for p, d in inv_delta.items() if d}
+    inv_frames = []
+    if inv_delta:
+        df_inv = apply_inventory_delta(df_inv, inv_delta)
+        inv_frames.append((df_inv, "Inventario", HEAD_INVENTARIO, "Producto", list(inv_delta)))
+
+    # Pedido y detalle solo crecen: se agregan las filas nuevas; del inventario solo cambian las filas de estos productos.
+    # Todo va en un solo batchUpdate.
+    persist_row_changes(inv_frames, appends=[([header_row], "Pedidos", HEAD_PEDIDOS, df_ped),
+                                             (detalle_rows, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE, df_det)],
+                        context=f"new order {pid}")
     log_info(f"Created order {pid} for client {cliente_id} with items {items}")
     return pid
 
-def get_order_details(order_id: int) -> pd.DataFrame:
+@st.cache_resource(show_spinner=False, ttl=SHEETS_CACHE_TTL, max_entries=4)
+def order_details_index(version: int) -> Tuple[pd.DataFrame, Dict[int, Any]]:
+    """Pedidos_detalle + posiciones de sus filas por ID Pedido. Solo lectura; se reconstruye al cambiar la versión de la hoja."""
     df_det = load_df("Pedidos_detalle")
-    if df_det.empty:
+    ids = df_det["ID Pedido"]
+    return df_det, ids.groupby(ids).indices
+
+def product_options() -> Tuple[List[str], Dict[str, int], List[str]]:
+    return _product_options(sheet_versions().get("Productos", 0))
+
+@st.cache_resource(show_spinner=False, ttl=SHEETS_CACHE_TTL, max_entries=4)
+def _product_options(version: int) -> Tuple[List[str], Dict[str, int], List[str]]:
+    """Nombres de Productos para los selectores, su posición (la primera si se repiten) y la lista con "-- Ninguno --".
+    Solo lectura."""
+    product_list = load_df("Productos", copy=False)["Nombre"].tolist()
+    product_index = {}
+    for i, p in enumerate(product_list):
+        product_index.setdefault(p, i)
+    return product_list, product_index, ["-- Ninguno --"] + product_list
+
+def client_names() -> Dict[int, str]:
+    return _client_names(sheet_versions().get("Clientes", 0))
+
+@st.cache_resource(show_spinner=False, ttl=SHEETS_CACHE_TTL, max_entries=4)
+def _client_names(version: int) -> Dict[int, str]:
+    """ID Cliente -> Nombre de load_df("Clientes"), en el orden de la tabla. Solo lectura."""
+    df_clients = load_df("Clientes", copy=False)
+    if df_clients.empty:
+        return {}
+    return dict(zip(df_clients["ID Cliente"].tolist(), df_clients["Nombre"].tolist()))
+
+@st.cache_resource(show_spinner=False, ttl=SHEETS_CACHE_TTL, max_entries=4)
+def _order_rows(version: int) -> Dict[int, Any]:
+    """ID Pedido -> etiqueta de su (primera) fila en load_df("Pedidos"). Solo lectura."""
+    ids = load_df("Pedidos", copy=False)["ID Pedido"]
+    rows = {}
+    for label, oid in zip(ids.index, ids):
+        rows.setdefault(int(oid), label)
+    return rows
+
+def order_row(df_ped: pd.DataFrame, order_id: int) -> Optional[Any]:
+    """Etiqueta de la fila del pedido en df_ped (un dict por versión en vez de recorrer la columna), o None si no está."""
+    idx = _order_rows(sheet_versions().get("Pedidos", 0)).get(int(order_id))
+    if idx is not None and idx in df_ped.index and df_ped.at[idx, "ID Pedido"] == int(order_id):
+        return idx
+    # df_ped no es la tabla de esta versión (p. ej. ya filtrada): se busca directo
+    hits = df_ped.index[df_ped["ID Pedido"] == int(order_id)]
+    return hits[0] if len(hits) else None
+
+def get_order_details(order_id: int) -> pd.DataFrame:
+    df_det, posiciones = order_details_index(sheet_versions().get("Pedidos_detalle", 0))
+    pos = posiciones.get(int(order_id))
+    if pos is None:
         return pd.DataFrame(columns=HEAD_PEDIDOS_DETALLE)
-    return df_det[df_det["ID Pedido"].astype(int) == int(order_id)].copy()
+    return df_det.iloc[pos].copy()
 
+@serialized_write
 def edit_order(order_id: int, new_items: Dict[str,int], new_domic_bool: bool=None, new_week: int=None, new_estado: str=None, new_descuento: float=None):
     df_ped = load_df("Pedidos")
     df_det = load_df("Pedidos_detalle")
     df_inv = load_df("Inventario")
     df_prod = load_df("Productos")
 
-    if df_ped.empty or order_id not in df_ped["ID Pedido"].astype(int).tolist():
+    idx_h = order_row(df_ped, order_id)
+    if idx_h is None:
         raise ValueError("Pedido no encontrado")
+    header_before = df_ped.loc[idx_h].copy()
+    lines_before = df_det[df_det["ID Pedido"] == int(order_id)]
 
-    old_lines = df_det[df_det["ID Pedido"].astype(int) == int(order_id)]
-    for _, r in old_lines.iterrows():
-        prod = canonical_product_name(r["Producto"])
-        qty = int(r["Cantidad"])
-        if prod in df_inv["Producto"].values:
-            idx = df_inv.index[df_inv["Producto"] == prod][0]
-            df_inv.at[idx, "Stock"] = int(df_inv.at[idx, "Stock"]) + qty
-        else:
-            df_inv = pd.concat([df_inv, pd.DataFrame([[prod, qty]], columns=HEAD_INVENTARIO)], ignore_index=True)
+    # Se devuelve al inventario lo del pedido anterior y se descuenta lo nuevo, en un solo paso
+    inv_delta = returned_stock(lines_before)
 
-    df_det = df_det[df_det["ID Pedido"].astype(int) != int(order_id)].reset_index(drop=True)
+    df_det = df_det[df_det["ID Pedido"] != int(order_id)].reset_index(drop=True)
 
+    precios = product_prices(df_prod)
+    detalle_rows = []
     for prod_raw, qty in new_items.items():
         prod = canonical_product_name(prod_raw)
-        price = df_prod.loc[df_prod["Nombre"] == prod, "Precio"].values[0] if not df_prod.empty and prod in df_prod["Nombre"].values else 0
+        price = precios.get(prod, 0)
         subtotal = int(qty) * int(price)
-        df_det = pd.concat([df_det, pd.DataFrame([[order_id, prod, int(qty), int(price), int(subtotal)]], columns=HEAD_PEDIDOS_DETALLE)], ignore_index=True)
-        if prod in df_inv["Producto"].values:
-            idx = df_inv.index[df_inv["Producto"] == prod][0]
-            df_inv.at[idx, "Stock"] = int(df_inv.at[idx, "Stock"]) - int(qty)
-        else:
-            df_inv = pd.concat([df_inv, pd.DataFrame([[prod, -int(qty)]], columns=HEAD_INVENTARIO)], ignore_index=True)
+        detalle_rows.append([order_id, prod, int(qty), int(price), int(subtotal)])
+        inv_delta[prod] = inv_delta.get(prod, 0) - int(qty)
+
+    df_det = pd.concat([df_det, pd.DataFrame(detalle_rows, columns=HEAD_PEDIDOS_DETALLE)], ignore_index=True)
+    # Un producto con la misma cantidad que antes no cambia su stock: no se toca ni se envía su fila
+    inv_delta = {p: d for p, d in inv_delta.items() if d}
+    if inv_delta:
+        df_inv = apply_inventory_delta(df_inv, inv_delta)
 
-    subtotal_new = sum(df_prod.loc[df_prod["Nombre"] == canonical_product_name(p), "Precio"].values[0] if not df_prod.empty and canonical_product_name(p) in df_prod["Nombre"].values else 0 * int(q) for p,q in new_items.items())
-    idx_h = df_ped.index[df_ped["ID Pedido"].astype(int) == int(order_id)][0]
+    # Subtotales de las líneas recién armadas: sin volver a normalizar nombres ni filtrar Productos por cada ítem
+    subtotal_new = sum(row[4] for row in detalle_rows)
     domicilio = float(df_ped.at[idx_h, "Monto_domicilio"]) if new_domic_bool is None else (DOMICILIO_COST if new_domic_bool else 0)
     descuento = float(df_ped.at[idx_h, "Descuento"]) if new_descuento is None else new_descuento
     total_new = (subtotal_new + domicilio) - descuento
@@ -667,68 +1804,56 @@ def edit_order(order_id: int, new_items: Dict[str,int], new_domic_bool: bool=Non
     if new_estado:
         df_ped.at[idx_h, "Estado"] = new_estado
 
-    df_inv["Producto"] = df_inv["Producto"].astype(str).apply(lambda x: canonical_product_name(x))
-    df_inv = df_inv.groupby("Producto", as_index=False).agg({"Stock":"sum"})
-
-    save_local_csv_by_sheet("Pedidos", df_ped)
-    save_local_csv_by_sheet("Pedidos_detalle", df_det)
-    save_local_csv_by_sheet("Inventario", df_inv)
-    try:
-        safe_write_df_to_sheet(df_ped, "Pedidos", HEAD_PEDIDOS)
-        safe_write_df_to_sheet(df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE)
-        safe_write_df_to_sheet(df_inv, "Inventario", HEAD_INVENTARIO)
-    except Exception as e:
-        log_warn(f"Best-effort sync failed on edit_order {order_id}: {e}")
-
-    flush_cache()
+    # Solo se guardan (local y Sheets) las hojas que de verdad cambiaron; basta comparar las filas de este pedido
+    frames = []
+    if not df_ped.loc[idx_h].equals(header_before):
+        frames.append((df_ped, "Pedidos", HEAD_PEDIDOS, "ID Pedido", [order_id]))
+    if sorted(map(tuple, lines_before[HEAD_PEDIDOS_DETALLE].values.tolist())) != sorted(map(tuple, detalle_rows)):
+        frames.append((df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE, "ID Pedido", [order_id]))
+    if inv_delta:
+        frames.append((df_inv, "Inventario", HEAD_INVENTARIO, "Producto", list(inv_delta)))
+    if not frames:
+        log_info(f"Order {order_id} unchanged; nothing to save.")
+        return
+    # Solo las filas de este pedido y de los productos afectados
+    persist_row_changes(frames, context=f"edit_order {order_id}")
     log_info(f"Edited order {order_id}")
 
+@serialized_write
 def delete_order(order_id: int):
     df_ped = load_df("Pedidos")
     df_det = load_df("Pedidos_detalle")
     df_inv = load_df("Inventario")
 
-    if df_ped.empty or order_id not in df_ped["ID Pedido"].astype(int).tolist():
+    if df_ped.empty or not (df_ped["ID Pedido"] == order_id).any():
         raise ValueError("Pedido no encontrado")
-    detalle = df_det[df_det["ID Pedido"].astype(int) == int(order_id)]
-    for _, r in detalle.iterrows():
-        prod = canonical_product_name(r["Producto"])
-        qty = int(r["Cantidad"])
-        if prod in df_inv["Producto"].values:
-            idx = df_inv.index[df_inv["Producto"] == prod][0]
-            df_inv.at[idx, "Stock"] = int(df_inv.at[idx, "Stock"]) + qty
-        else:
-            df_inv = pd.concat([df_inv, pd.DataFrame([[prod, qty]], columns=HEAD_INVENTARIO)], ignore_index=True)
-    df_det = df_det[df_det["ID Pedido"].astype(int) != int(order_id)].reset_index(drop=True)
-    df_ped = df_ped[df_ped["ID Pedido"].astype(int) != int(order_id)].reset_index(drop=True)
-    df_inv["Producto"] = df_inv["Producto"].astype(str).apply(lambda x: canonical_product_name(x))
-    df_inv = df_inv.groupby("Producto", as_index=False).agg({"Stock":"sum"})
-
-    save_local_csv_by_sheet("Pedidos", df_ped)
-    save_local_csv_by_sheet("Pedidos_detalle", df_det)
-    save_local_csv_by_sheet("Inventario", df_inv)
-    try:
-        safe_write_df_to_sheet(df_ped, "Pedidos", HEAD_PEDIDOS)
-        safe_write_df_to_sheet(df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE)
-        safe_write_df_to_sheet(df_inv, "Inventario", HEAD_INVENTARIO)
-    except Exception as e:
-        log_warn(f"Best-effort sync failed on delete_order {order_id}: {e}")
+    inv_delta = returned_stock(df_det[df_det["ID Pedido"] == int(order_id)])
+    df_det = df_det[df_det["ID Pedido"] != int(order_id)].reset_index(drop=True)
+    df_ped = df_ped[df_ped["ID Pedido"] != int(order_id)].reset_index(drop=True)
+    frames = [
+        (df_ped, "Pedidos", HEAD_PEDIDOS, "ID Pedido", [order_id]),
+        (df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE, "ID Pedido", [order_id]),
+    ]
+    if inv_delta:
+        df_inv = apply_inventory_delta(df_inv, inv_delta)
+        frames.append((df_inv, "Inventario", HEAD_INVENTARIO, "Producto", list(inv_delta)))
 
-    flush_cache()
+    # Solo las filas de este pedido y de los productos afectados
+    persist_row_changes(frames, context=f"delete_order {order_id}")
     log_info(f"Deleted order {order_id}")
 
+@serialized_write
 def register_payment(order_id: int, medio_pago: str, monto: float) -> Dict[str, float]:
     df_ped = load_df("Pedidos")
-    df_flu = load_df("FlujoCaja")
-    if df_ped.empty or order_id not in df_ped["ID Pedido"].astype(int).tolist():
+    df_flu = load_df("FlujoCaja", copy=False)  # solo se extiende con concat
+    idx = order_row(df_ped, order_id)
+    if idx is None:
         raise ValueError("Pedido no encontrado")
-    idx = df_ped.index[df_ped["ID Pedido"].astype(int) == int(order_id)][0]
     
-    subtotal_products = float(df_ped.at[idx, "Subtotal_productos"])
-    domicilio_monto = float(df_ped.at[idx, "Monto_domicilio"])
-    descuento_monto = float(df_ped.at[idx, "Descuento"])
-    monto_anterior = float(df_ped.at[idx, "Monto_pagado"])
-    saldo_pendiente_anterior = float(df_ped.at[idx, "Saldo_pendiente"])
+    # Columnas ya numéricas desde load_df: los cinco montos del pedido salen de una sola lectura de la fila
+    subtotal_products, domicilio_monto, descuento_monto, monto_anterior, saldo_pendiente_anterior = (
+        df_ped.loc[idx, ["Subtotal_productos", "Monto_domicilio", "Descuento", "Monto_pagado", "Saldo_pendiente"]]
+        .to_numpy(dtype=float).tolist())
 
     # CORREGIDO: Validación para no pagar más de lo debido
     if monto > saldo_pendiente_anterior:
@@ -756,13 +1881,6 @@ def register_payment(order_id: int, medio_pago: str, monto: float) -> Dict[str,
     # CORREGIDO: Usamos una tolerancia de 0.01 para decidir si el pedido está entregado
     df_ped.at[idx, "Estado"] = "Entregado" if saldo_total <= 0.01 else "Pendiente"
 
-    # CORREGIDO: Guardado consistente del pedido
-    save_local_csv_by_sheet("Pedidos", df_ped)
-    try:
-        safe_write_df_to_sheet(df_ped, "Pedidos", HEAD_PEDIDOS)
-    except Exception as e:
-        log_warn(f"Best-effort sync failed on register_payment for order {order_id}: {e}")
-
     fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     new_flow = {
         "Fecha": fecha, "ID Pedido": int(order_id), "Cliente": df_ped.at[idx, "Nombre Cliente"],
@@ -772,57 +1890,63 @@ def register_payment(order_id: int, medio_pago: str, monto: float) -> Dict[str,
         df_flu = pd.DataFrame([new_flow], columns=HEAD_FLUJO)
     else:
         df_flu = pd.concat([df_flu, pd.DataFrame([new_flow])], ignore_index=True)
-    save_local_csv_by_sheet("FlujoCaja", df_flu)
-    try:
-        safe_write_df_to_sheet(df_flu, "FlujoCaja", HEAD_FLUJO)
-    except Exception as e:
-        log_warn(f"Best-effort sync failed on register_payment for order {order_id}: {e}")
 
-    flush_cache()
+    # CORREGIDO: Guardado consistente del pedido
+    # La fila del pedido y el movimiento de caja van juntos: una sola tarea y un solo batchUpdate
+    persist_row_changes([(df_ped, "Pedidos", HEAD_PEDIDOS, "ID Pedido", [order_id])],
+                        appends=[([new_flow], "FlujoCaja", HEAD_FLUJO, df_flu)],
+                        context=f"register_payment for order {order_id}")
     log_info(f"Payment registered for order {order_id}: amount={monto}, medio={medio_pago}")
     return {"prod_paid": prod_now, "domicilio_paid": domicilio_now, "saldo_total": saldo_total}
 
-def totals_by_payment_method() -> Dict[str, float]:
-    df_f = load_df("FlujoCaja")
+def totals_by_payment_method() -> pd.Series:
+    return _totals_by_payment_method(sheet_versions().get("FlujoCaja", 0))
+
+@st.cache_data(ttl=SHEETS_CACHE_TTL, show_spinner=False)
+def _totals_by_payment_method(version: int) -> pd.Series:
+    """Total de ingresos por medio de pago, como Series (índice Medio_pago) lista para .to_frame()."""
+    df_f = load_df("FlujoCaja", copy=False)
     if df_f.empty:
-        return {}
-    coerce_cols = ["Ingreso_productos_recibido", "Ingreso_domicilio_recibido"]
-    for c in coerce_cols:
-        if c in df_f.columns:
-            df_f[c] = pd.to_numeric(df_f[c], errors='coerce').fillna(0)
-    df_f["total"] = df_f["Ingreso_productos_recibido"].fillna(0) + df_f["Ingreso_domicilio_recibido"].fillna(0)
-    grouped = df_f.groupby("Medio_pago")["total"].sum().to_dict()
-    return {k: float(v) for k,v in grouped.items()}
-
-def flow_summaries() -> Tuple[float, float, float, float, float]:
-    df_f = load_df("FlujoCaja")
-    df_g = load_df("Gastos")
-    if not df_f.empty:
-        df_f["Ingreso_productos_recibido"] = pd.to_numeric(df_f["Ingreso_productos_recibido"], errors='coerce').fillna(0)
-        df_f["Ingreso_domicilio_recibido"] = pd.to_numeric(df_f["Ingreso_domicilio_recibido"], errors='coerce').fillna(0)
-    total_prod = df_f["Ingreso_productos_recibido"].sum() if not df_f.empty else 0
-    total_dom = df_f["Ingreso_domicilio_recibido"].sum() if not df_f.empty else 0
-    total_gastos = df_g["Monto"].sum() if not df_g.empty else 0
+        return pd.Series(dtype="float64", name="Total_ingresos").rename_axis("Medio_pago")
+    # Los montos ya llegan numéricos desde load_df: suma directa de arrays y un solo groupby (sin pasar por categorías)
+    total = df_f["Ingreso_productos_recibido"].to_numpy() + df_f["Ingreso_domicilio_recibido"].to_numpy()
+    grouped = pd.Series(total, index=df_f.index, dtype="float64").groupby(df_f["Medio_pago"]).sum()
+    return grouped.rename("Total_ingresos").rename_axis("Medio_pago")
+
+def flow_summaries() -> Tuple[float, float, float, float]:
+    versions = sheet_versions()
+    return _flow_summaries(versions.get("FlujoCaja", 0), versions.get("Gastos", 0))
+
+@st.cache_data(ttl=SHEETS_CACHE_TTL, show_spinner=False)
+def _flow_summaries(flujo_version: int, gastos_version: int) -> Tuple[float, float, float, float]:
+    df_f = load_df("FlujoCaja", copy=False)
+    df_g = load_df("Gastos", copy=False)
+    # Columnas numéricas desde load_df: sumas vectorizadas, sin copiar ni recoercer la tabla
+    total_prod, total_dom = (df_f[["Ingreso_productos_recibido", "Ingreso_domicilio_recibido"]].sum().astype(float).tolist()
+                             if not df_f.empty else (0.0, 0.0))
+    total_gastos = float(df_g["Monto"].sum()) if not df_g.empty else 0.0
     saldo = total_prod + total_dom - total_gastos
     return total_prod, total_dom, total_gastos, saldo
 
+@serialized_write
 def add_expense(concepto: str, monto: float):
-    df_g = load_df("Gastos")
+    df_g = load_df("Gastos", copy=False)
     fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     new_row = {"Fecha": fecha, "Concepto": concepto, "Monto": monto}
     if df_g.empty:
         df_g = pd.DataFrame([new_row], columns=HEAD_GASTOS)
     else:
         df_g = pd.concat([df_g, pd.DataFrame([new_row])], ignore_index=True)
-    save_local_csv_by_sheet("Gastos", df_g)
+    append_local_csv_by_sheet("Gastos", [new_row], df_g)
     try:
-        safe_write_df_to_sheet(df_g, "Gastos", HEAD_GASTOS)
+        schedule_sheet_write(["Gastos"], safe_append_rows_to_sheet, [new_row], "Gastos", HEAD_GASTOS, full_df=df_g)
     except Exception as e:
         log_warn(f"Best-effort sync failed on add_expense: {e}")
-    flush_cache()
+    publish_frames({"Gastos": df_g})
 
+@serialized_write
 def move_funds(amount: float, from_method: str, to_method: str, note: str="Movimiento interno"):
-    df_f = load_df("FlujoCaja")
+    df_f = load_df("FlujoCaja", copy=False)
     fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     neg = {"Fecha": fecha, "ID Pedido": 0, "Cliente": note + f" ({from_method} -> {to_method})", "Medio_pago": from_method, "Ingreso_productos_recibido": -float(amount), "Ingreso_domicilio_recibido": 0, "Saldo_pendiente_total": 0}
     pos = {"Fecha": fecha, "ID Pedido": 0, "Cliente": note + f" ({from_method} -> {to_method})", "Medio_pago": to_method, "Ingreso_productos_recibido": float(amount), "Ingreso_domicilio_recibido": 0, "Saldo_pendiente_total": 0}
@@ -831,12 +1955,12 @@ def move_funds(amount: float, from_method: str, to_method: str, note: str="Movim
         df_f = df_new
     else:
         df_f = pd.concat([df_f, df_new], ignore_index=True)
-    save_local_csv_by_sheet("FlujoCaja", df_f)
+    append_local_csv_by_sheet("FlujoCaja", [neg, pos], df_f)
     try:
-        safe_write_df_to_sheet(df_f, "FlujoCaja", HEAD_FLUJO)
+        schedule_sheet_write(["FlujoCaja"], safe_append_rows_to_sheet, [neg, pos], "FlujoCaja", HEAD_FLUJO, full_df=df_f)
     except Exception as e:
         log_warn(f"Best-effort sync failed on move_funds: {e}")
-    flush_cache()
+    publish_frames({"FlujoCaja": df_f})
 
 # ---------------------------
 # MÓDULO DE FACTURACIÓN PDF (MEJORADO)
@@ -850,7 +1974,8 @@ def get_next_invoice_number() -> int:
                 last_num_str = ws.acell('B2').value
                 last_num = int(last_num_str) if last_num_str and last_num_str.isdigit() else 0
                 new_num = last_num + 1
-                ws.update('B2', str(new_num))
+                # Un solo values.update con la celda como matriz (valores primero, rango después en gspread 6)
+                ws.update([[new_num]], 'B2', value_input_option="RAW")
                 log_info(f"Invoice number {new_num} read and updated in Google Sheets.")
                 return new_num
         except Exception as e:
@@ -883,13 +2008,13 @@ def get_next_invoice_number() -> int:
 def generate_invoice_pdf(order_id: int, invoice_number: int) -> str:
     if not PDF_AVAILABLE:
         raise ImportError("La librería 'reportlab' no está instalada. Ejecuta 'pip install reportlab'.")
-    df_ped = load_df("Pedidos")
-    df_det = load_df("Pedidos_detalle")
-    df_cli = load_df("Clientes")
+    df_ped = load_df("Pedidos", copy=False)
+    df_cli = load_df("Clientes", copy=False)
 
-    order_header = df_ped[df_ped["ID Pedido"].astype(int) == order_id].iloc[0]
+    # IDs ya llegan enteros desde load_df: se compara la columna tal cual, sin convertirla
+    order_header = df_ped.loc[order_row(df_ped, order_id)]
     order_details = get_order_details(order_id)
-    client_info = df_cli[df_cli["ID Cliente"].astype(int) == order_header["ID Cliente"]].iloc[0]
+    client_info = df_cli[df_cli["ID Cliente"] == int(order_header["ID Cliente"])].iloc[0]
 
     pdf_filename = f"Factura_{order_id}_{invoice_number:03d}.pdf"
     pdf_path = FACTURAS_DIR / pdf_filename
@@ -956,12 +2081,13 @@ def generate_invoice_pdf(order_id: int, invoice_number: int) -> str:
     story.append(Spacer(1, 12))
 
     data_products = [["Cant.", "Descripción", "P.U.", "Total"]]
-    for _, row in order_details.iterrows():
+    for cantidad, producto, precio, subtotal in zip(order_details['Cantidad'], order_details['Producto'],
+                                                    order_details['Precio_unitario'], order_details['Subtotal']):
         data_products.append([
-            str(row['Cantidad']),
-            row['Producto'],
-            f"{int(row['Precio_unitario']):,}".replace(',', '.'),
-            f"{int(row['Subtotal']):,}".replace(',', '.')
+            str(cantidad),
+            producto,
+            f"{int(precio):,}".replace(',', '.'),
+            f"{int(subtotal):,}".replace(',', '.')
         ])
     
     tbl_products = Table(data_products, colWidths=[0.8*inch, 4*inch, 1.2*inch, 1.2*inch])
@@ -1015,17 +2141,47 @@ def generate_invoice_pdf(order_id: int, invoice_number: int) -> str:
 # REPORTS HELPERS
 # ---------------------------
 
-def unidades_vendidas_por_producto(df_det: pd.DataFrame = None) -> Dict[str, int]:
+def unidades_vendidas_por_producto(df_det: pd.DataFrame = None) -> pd.Series:
+    """Unidades vendidas por producto (índice Producto); los productos sin ventas quedan en 0."""
+    nombres = load_df("Productos", copy=False)["Nombre"]
     if df_det is None or df_det.empty:
-        return {p: 0 for p in load_df("Productos")["Nombre"].tolist()}
-    res = {}
-    for _, r in df_det.iterrows():
-        prod = r.get("Producto")
-        qty = int(r.get("Cantidad", 0))
-        res[prod] = res.get(prod, 0) + qty
-    for p in load_df("Productos")["Nombre"].tolist():
-        res.setdefault(p, 0)
-    return res
+        res = pd.Series(0, index=nombres.to_numpy(), dtype="int64")
+    else:
+        cantidades = pd.to_numeric(df_det["Cantidad"], errors="coerce").fillna(0).astype(int)
+        res = cantidades.groupby(df_det["Producto"], sort=False).sum()
+        sin_ventas = nombres[~nombres.isin(res.index)].to_numpy()
+        if len(sin_ventas):
+            res = pd.concat([res, pd.Series(0, index=sin_ventas, dtype=res.dtype)])
+    return res.rename("Unidades vendidas").rename_axis("Producto")
+
+def pedidos_week_options() -> List[str]:
+    return _pedidos_week_options(sheet_versions().get("Pedidos", 0))
+
+@st.cache_data(ttl=SHEETS_CACHE_TTL, show_spinner=False)
+def _pedidos_week_options(version: int) -> List[str]:
+    """Opciones del filtro por semana ISO: "Todas" y las semanas de entrega presentes en Pedidos."""
+    df_ped = load_df("Pedidos", copy=False)
+    if df_ped.empty:
+        return ["Todas"]
+    weeks = pd.to_numeric(df_ped["Semana_entrega"], errors='coerce').dropna().astype(int).unique()
+    return ["Todas"] + [str(w) for w in sorted(weeks) if w > 0]
+
+def pedidos_week_positions(df_ped: pd.DataFrame) -> Dict[int, Any]:
+    """Posiciones de fila de df_ped por semana de entrega, para filtrar con take() sin recorrer la tabla.
+
+    Se calculan sobre el mismo df_ped que se va a filtrar y se guardan en la sesión junto a ese objeto:
+    mientras load_df devuelva la misma tabla se reutilizan, y cualquier tabla nueva las recalcula.
+    """
+    cached = st.session_state.get("week_positions")
+    if cached is not None and cached[0] is df_ped:
+        return cached[1]
+    if df_ped.empty:
+        positions = {}
+    else:
+        weeks = pd.to_numeric(df_ped["Semana_entrega"], errors='coerce').fillna(0).astype(int)
+        positions = {int(w): pos for w, pos in weeks.groupby(weeks, sort=False).indices.items()}
+    st.session_state["week_positions"] = (df_ped, positions)
+    return positions
 
 def ventas_por_semana(df_ped: pd.DataFrame) -> pd.DataFrame:
     if df_ped is None or df_ped.empty:
@@ -1039,7 +2195,6 @@ def ventas_por_semana(df_ped: pd.DataFrame) -> pd.DataFrame:
 def get_top_clients_report(df_ped: pd.DataFrame) -> pd.DataFrame:
     if df_ped.empty:
         return pd.DataFrame(columns=["Cliente", "Total Gastado", "Número de Pedidos"])
-    df_ped["Total_pedido"] = pd.to_numeric(df_ped["Total_pedido"], errors='coerce').fillna(0)
     report = df_ped.groupby("Nombre Cliente").agg(
         Total_Gastado=pd.NamedAgg(column="Total_pedido", aggfunc="sum"),
         Numero_de_Pedidos=pd.NamedAgg(column="ID Pedido", aggfunc="count")
@@ -1050,10 +2205,8 @@ def get_top_clients_report(df_ped: pd.DataFrame) -> pd.DataFrame:
 def get_product_profitability_report(df_det: pd.DataFrame, df_prod: pd.DataFrame) -> pd.DataFrame:
     if df_det.empty or df_prod.empty:
         return pd.DataFrame(columns=["Producto", "Unidades Vendidas", "Ganancia Total"])
-    
-    df_det["Subtotal"] = pd.to_numeric(df_det["Subtotal"], errors='coerce').fillna(0)
-    df_prod["Costo"] = pd.to_numeric(df_prod["Costo"], errors='coerce').fillna(0)
-    
+
+    # load_df ya entrega Subtotal/Costo numéricos: no se reconvierte (ni se modifica) la tabla recibida
     merged_df = pd.merge(df_det, df_prod, left_on="Producto", right_on="Nombre")
     
     merged_df["Ganancia_Unitaria"] = merged_df["Precio_unitario"] - merged_df["Costo"]
@@ -1076,6 +2229,9 @@ st.title("🫐 AndicBlue — Gestión de Pedidos, Inventario y Flujo (Local + Sy
 col1, col2, col3, col4 = st.columns([3,2,2,1])
 with col1:
     st.markdown("#### Estado de sincronización")
+    pendientes = pending_sheet_writes() if GS_CLIENT else []
+    if pendientes:
+        st.caption(f"⏳ Sincronizando con Sheets: {', '.join(pendientes)}")
 with col2:
     sheets_status = "Disponible" if GS_CLIENT and GS_SPREADSHEET else "No conectado"
     st.info(f"Google Sheets: **{sheets_status}**")
@@ -1084,9 +2240,16 @@ with col3:
 with col4:
     st.write(" ")
 
+# Valores por defecto de widgets con key: se fijan una sola vez por sesión
+for _key, _default in {"move_from": "Transferencia", "move_to": "Efectivo", "move_note": "Movimiento interno"}.items():
+    st.session_state.setdefault(_key, _default)
+
 st.sidebar.header("Menú")
 menu = st.sidebar.selectbox("Selecciona módulo", ["Dashboard", "Clientes", "Productos", "Pedidos", "Entregas/Pagos", "Inventario", "Flujo & Gastos", "Reportes", "Facturación 🧾", "Sincronización"])
 
+# Hojas a pedir juntas en este rerun: load_df las pasa por argumento hasta read_sheet_values
+st.session_state["prefetch_sheets"] = MENU_SHEETS.get(menu, BATCH_SHEETS)
+
 if st.sidebar.button("🔁 Sincronizar local -> Sheets (manual)"):
     try:
         df_clients = load_local_csv(CSV_CLIENTES, HEAD_CLIENTES)
@@ -1096,13 +2259,16 @@ if st.sidebar.button("🔁 Sincronizar local -> Sheets (manual)"):
         df_flu = load_local_csv(CSV_FLUJO, HEAD_FLUJO)
         df_gas = load_local_csv(CSV_GASTOS, HEAD_GASTOS)
         df_prod = load_local_csv(CSV_PRODUCTOS, HEAD_PRODUCTOS)
-        ok_clients = safe_write_df_to_sheet(df_clients, "Clientes", HEAD_CLIENTES)
-        ok_ped = safe_write_df_to_sheet(df_ped, "Pedidos", HEAD_PEDIDOS)
-        ok_det = safe_write_df_to_sheet(df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE)
-        ok_inv = safe_write_df_to_sheet(df_inv, "Inventario", HEAD_INVENTARIO)
-        ok_flu = safe_write_df_to_sheet(df_flu, "FlujoCaja", HEAD_FLUJO)
-        ok_gas = safe_write_df_to_sheet(df_gas, "Gastos", HEAD_GASTOS)
-        ok_prod = safe_write_df_to_sheet(df_prod, "Productos", HEAD_PRODUCTOS)
+        wait_for_sheet_writes()
+        ok_all = safe_write_dfs_to_sheets([
+            (df_clients, "Clientes", HEAD_CLIENTES),
+            (df_ped, "Pedidos", HEAD_PEDIDOS),
+            (df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE),
+            (df_inv, "Inventario", HEAD_INVENTARIO),
+            (df_flu, "FlujoCaja", HEAD_FLUJO),
+            (df_gas, "Gastos", HEAD_GASTOS),
+            (df_prod, "Productos", HEAD_PRODUCTOS),
+        ], rebase=False)  # sincronización manual: lo local manda
         st.success("Intento de sincronización iniciado (revisa logs para detalles).")
         log_info("Manual sync local->sheets requested by user.")
     except Exception as e:
@@ -1110,79 +2276,113 @@ if st.sidebar.button("🔁 Sincronizar local -> Sheets (manual)"):
         log_error(f"Manual sync failed: {e}")
 
 # ---------------------------
-# DASHBOARD
+# VISTAS CON FRAGMENTOS (una interacción dentro del panel solo re-ejecuta el panel)
 # ---------------------------
-if menu == "Dashboard":
-    st.header("📊 Dashboard — Resumen")
-    
-    with st.expander("📅 Filtrar por rango de fechas"):
-        col1, col2 = st.columns(2)
-        with col1:
-            start_date = st.date_input("Fecha de inicio", value=datetime.now().date() - timedelta(days=30))
-        with col2:
-            end_date = st.date_input("Fecha de fin", value=datetime.now().date())
-    
-    df_ped = load_df("Pedidos")
-    df_det = load_df("Pedidos_detalle")
-    df_flu = load_df("FlujoCaja")
-    df_gas = load_df("Gastos")
-    df_inv = load_df("Inventario")
-    df_clients = load_df("Clientes")
-
-    if not df_ped.empty:
-        df_ped['Fecha'] = pd.to_datetime(df_ped['Fecha'], errors='coerce')
-        mask = (df_ped['Fecha'].dt.date >= start_date) & (df_ped['Fecha'].dt.date <= end_date)
-        df_ped_filtered = df_ped.loc[mask]
-    else:
-        df_ped_filtered = pd.DataFrame()
-
-    total_orders = 0 if df_ped_filtered.empty else len(df_ped_filtered)
-    total_clients = 0 if df_clients.empty else df_clients["ID Cliente"].nunique()
-    total_revenue = 0
-    if not df_flu.empty:
-        df_flu["Ingreso_productos_recibido"] = pd.to_numeric(df_flu["Ingreso_productos_recibido"], errors='coerce').fillna(0)
-        df_flu["Ingreso_domicilio_recibido"] = pd.to_numeric(df_flu["Ingreso_domicilio_recibido"], errors='coerce').fillna(0)
-        df_flu['Fecha'] = pd.to_datetime(df_flu['Fecha'], errors='coerce')
-        mask_flu = (df_flu['Fecha'].dt.date >= start_date) & (df_flu['Fecha'].dt.date <= end_date)
-        df_flu_filtered = df_flu.loc[mask_flu]
-        total_revenue = int(df_flu_filtered["Ingreso_productos_recibido"].sum() + df_flu_filtered["Ingreso_domicilio_recibido"].sum())
-    total_expenses = 0 if df_gas.empty else int(pd.to_numeric(df_gas["Monto"], errors='coerce').sum())
-    balance = total_revenue - total_expenses
-
-    k1,k2,k3,k4 = st.columns(4)
-    k1.metric("Pedidos (en rango)", f"{int(total_orders):,}")
-    k2.metric("Clientes Totales", f"{int(total_clients):,}")
-    k3.metric("Ingresos (en rango)", f"{int(total_revenue):,} COP")
-    k4.metric("Saldo neto", f"{int(balance):,} COP")
 
-    st.markdown("---")
-    st.subheader("Ventas por producto (en rango)")
-    if not df_ped_filtered.empty and PLOTLY_AVAILABLE:
-        df_det_filtered = df_det[df_det["ID Pedido"].isin(df_ped_filtered["ID Pedido"])]
-        df_det_local = df_det_filtered.copy()
-        df_det_local["Subtotal"] = pd.to_numeric(df_det_local["Subtotal"], errors='coerce').fillna(0)
-        ventas_prod = df_det_local.groupby("Producto")["Subtotal"].sum().reset_index().sort_values("Subtotal", ascending=False)
-        fig = px.bar(ventas_prod, x="Producto", y="Subtotal", title="Ingresos por producto (COP)")
-        st.plotly_chart(fig, use_container_width=True)
+# Separador de miles colombiano (punto); la tabla de traducción se arma una sola vez
+_COP_THOUSANDS = str.maketrans(",", ".")
+
+def format_cop(value) -> str:
+    """Monto entero en COP con punto de miles, p. ej. 1.234.567 COP."""
+    return f"{int(value):,} COP".translate(_COP_THOUSANDS)
+
+def dates_in_range(fechas: pd.Series, start_date: date, end_date: date) -> pd.Series:
+    """Máscara de fechas entre start_date y end_date (inclusive), comparando datetime64 sin pasar por .dt.date."""
+    desde = pd.Timestamp(start_date)
+    hasta = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+    return (fechas >= desde) & (fechas < hasta)
+
+def set_flash(slot: str, kind: str, msg: str):
+    """Guarda un mensaje (success/error/...) para mostrarlo en el siguiente render."""
+    st.session_state[f"flash_{slot}"] = (kind, msg)
+
+def show_flash(slot: str):
+    flash = st.session_state.pop(f"flash_{slot}", None)
+    if flash:
+        kind, msg = flash
+        getattr(st, kind)(msg)
+
+def compact_for_display(df: pd.DataFrame) -> pd.DataFrame:
+    """Copia con tipos más angostos para st.dataframe (menos bytes en Arrow). Solo para mostrar, nunca para guardar.
+
+    Enteros al menor tipo con signo, float32 solo si no pierde precisión y texto repetido como category.
+    """
+    out = df.copy()
+    for c in out.select_dtypes("int64").columns:
+        out[c] = pd.to_numeric(out[c], downcast="integer")
+    for c in out.select_dtypes("float64").columns:
+        as32 = out[c].astype("float32")
+        if ((as32.astype("float64") == out[c]) | out[c].isna()).all():
+            out[c] = as32
+    if len(out):
+        for c in out.select_dtypes("object").columns:
+            if pd.api.types.infer_dtype(out[c], skipna=True) == "string" and out[c].nunique() < len(out) / 2:
+                out[c] = out[c].astype("category")
+    return out
+
+@st.fragment
+def paginated_dataframe(df: pd.DataFrame, key: str, page_size: int = REPORT_PAGE_SIZE, last_page_first: bool = True):
+    """Muestra una página del DataFrame (por defecto la última, la más reciente) en vez de la tabla completa.
+
+    Es un fragmento propio: cambiar de página solo vuelve a dibujar esta tabla. Para rankings
+    (ya ordenados de mayor a menor) usar last_page_first=False.
+    """
+    n_pages = max(1, math.ceil(len(df) / page_size))
+    page = n_pages if last_page_first else 1
+    if n_pages > 1:
+        page = int(st.number_input(f"Página (1-{n_pages})", min_value=1, max_value=n_pages, value=page, step=1, key=key))
+    start = (page - 1) * page_size
+    st.dataframe(compact_for_display(df.iloc[start:start + page_size]), use_container_width=True)
+
+# Callbacks de formularios: se ejecutan antes del rerun y solo limpian los campos si la escritura fue exitosa
+
+def _on_add_client():
+    ss = st.session_state
+    nombre, num_doc = ss.new_client_nombre, ss.new_client_num_doc
+    if not nombre or not num_doc:
+        set_flash("add_client", "error", "Nombre y número de documento son obligatorios")
+        return
+    try:
+        cid = create_client(nombre, ss.new_client_tipo_doc, num_doc, ss.new_client_telefono, ss.new_client_direccion)
+    except Exception as e:
+        set_flash("add_client", "error", f"Error agregando cliente: {e}")
+        return
+    set_flash("add_client", "success", f"Cliente agregado con ID {cid}")
+    for k in ("new_client_nombre", "new_client_num_doc", "new_client_telefono", "new_client_direccion"):
+        ss[k] = ""
+    ss.new_client_tipo_doc = "CC"
+
+def _on_move_funds():
+    ss = st.session_state
+    amt, from_m, to_m = ss.move_amt, ss.move_from, ss.move_to
+    if amt <= 0:
+        set_flash("move", "error", "Monto debe ser mayor a 0")
+    elif from_m == to_m:
+        set_flash("move", "error", "Los medios deben ser diferentes")
     else:
-        st.info("No hay detalle de pedidos para graficar en el rango seleccionado.")
+        try:
+            move_funds(amt, from_m, to_m, ss.move_note)
+            set_flash("move", "success", "Movimiento registrado")
+            ss.move_amt = 0.0
+        except Exception as e:
+            set_flash("move", "error", f"Error registrando movimiento: {e}")
 
-    st.markdown("---")
-    st.subheader("Stock actual")
-    if not df_inv.empty:
-        df_inv_local = df_inv.copy()
-        df_inv_local["Stock"] = pd.to_numeric(df_inv_local["Stock"], errors='coerce').fillna(0).astype(int)
-        st.dataframe(df_inv_local.sort_values("Stock"), use_container_width=True)
-    else:
-        st.info("Inventario vacío.")
+def _on_add_expense():
+    ss = st.session_state
+    try:
+        add_expense(ss.gasto_concepto, float(ss.gasto_monto))
+        set_flash("gasto", "success", "Gasto agregado.")
+        ss.gasto_concepto = ""
+        ss.gasto_monto = 0.0
+    except Exception as e:
+        set_flash("gasto", "error", f"Error agregando gasto: {e}")
 
-# ---------------------------
-# CLIENTES
-# ---------------------------
-elif menu == "Clientes":
+@st.fragment
+def render_clientes():
     st.header("👥 Clientes")
-    df_clients = load_df("Clientes")
-    
+    df_clients = load_df("Clientes", copy=False)
+    selected_client_option = None
+
     search_term = st.text_input("🔍 Buscar cliente por nombre, documento o teléfono", key="client_search").lower()
     
     if not df_clients.empty:
@@ -1196,40 +2396,37 @@ elif menu == "Clientes":
         else:
             df_clients_filtered = df_clients
         
-        st.dataframe(df_clients_filtered, use_container_width=True)
+        st.dataframe(clients_arrow_table(df_clients_filtered, sheet_versions().get("Clientes", 0)), use_container_width=True)
     else:
         st.info("No hay clientes registrados.")
 
     with st.expander("➕ Agregar nuevo cliente"):
         with st.form("form_add_client"):
             st.subheader("Agregar nuevo cliente")
-            nombre = st.text_input("Nombre completo")
+            st.text_input("Nombre completo", key="new_client_nombre")
             col1, col2 = st.columns(2)
             with col1:
-                tipo_doc = st.selectbox("Tipo de Documento", ["CC", "NIT"])
+                st.selectbox("Tipo de Documento", ["CC", "NIT"], key="new_client_tipo_doc")
             with col2:
-                num_doc = st.text_input("Número de Documento")
-            telefono = st.text_input("Teléfono")
-            direccion = st.text_input("Dirección")
-            submitted = st.form_submit_button("Agregar cliente")
-            if submitted:
-                if not nombre or not num_doc:
-                    st.error("Nombre y número de documento son obligatorios")
-                else:
-                    cid = create_client(nombre, tipo_doc, num_doc, telefono, direccion)
-                    st.success(f"Cliente agregado con ID {cid}")
-                    st.rerun()
+                st.text_input("Número de Documento", key="new_client_num_doc")
+            st.text_input("Teléfono", key="new_client_telefono")
+            st.text_input("Dirección", key="new_client_direccion")
+            st.form_submit_button("Agregar cliente", on_click=_on_add_client)
+        show_flash("add_client")
 
     with st.expander("✏️ Editar cliente existente"):
         if df_clients.empty:
             st.warning("No hay clientes registrados para editar.")
         else:
-            client_options = df_clients["ID Cliente"].astype(str) + " - " + df_clients["Nombre"]
-            selected_client_option = st.selectbox("Selecciona un cliente para editar", ["-- Seleccionar --"] + client_options.tolist())
+            # Opciones = IDs; la etiqueta "ID - Nombre" solo se arma al mostrar
+            name_by_id = client_names()
+            selected_client_option = st.selectbox(
+                "Selecciona un cliente para editar", [None] + list(name_by_id),
+                format_func=lambda cid: "-- Seleccionar --" if cid is None else f"{cid} - {name_by_id[cid]}")
 
-            if selected_client_option != "-- Seleccionar --":
-                client_id_to_edit = int(selected_client_option.split(" - ")[0])
-                client_data = df_clients[df_clients["ID Cliente"].astype(int) == int(client_id_to_edit)].iloc[0]
+            if selected_client_option is not None:
+                client_id_to_edit = int(selected_client_option)
+                client_data = df_clients[df_clients["ID Cliente"] == client_id_to_edit].iloc[0]
 
                 with st.form(key="edit_client_form"):
                     st.subheader(f"Editando a: {client_data['Nombre']}")
@@ -1256,10 +2453,10 @@ elif menu == "Clientes":
                             except Exception as e:
                                 st.error(f"Error al actualizar cliente: {e}")
     
-    if selected_client_option != "-- Seleccionar --" and selected_client_option:
+    if selected_client_option is not None:
         with st.expander(f"📜 Historial de Pedidos para: {client_data['Nombre']}"):
-            df_ped = load_df("Pedidos")
-            client_orders = df_ped[df_ped["ID Cliente"].astype(int) == client_id_to_edit]
+            df_ped = load_df("Pedidos", copy=False)
+            client_orders = df_ped[df_ped["ID Cliente"] == client_id_to_edit]
             if not client_orders.empty:
                 st.dataframe(client_orders, use_container_width=True)
                 total_spent = pd.to_numeric(client_orders["Total_pedido"], errors='coerce').sum()
@@ -1267,12 +2464,162 @@ elif menu == "Clientes":
             else:
                 st.info("Este cliente no tiene pedidos registrados.")
 
-# ---------------------------
-# NUEVO: PRODUCTOS (CRUD)
-# ---------------------------
-elif menu == "Productos":
+@st.fragment
+def render_flujo_gastos():
+    st.header("💰 Flujo de caja y Gastos")
+    total_prod, total_dom, total_gastos, saldo = flow_summaries()
+    c1,c2,c3,c4 = st.columns([3,2,2,1])
+    c1.metric("Ingresos productos", format_cop(total_prod))
+    c2.metric("Ingresos domicilios", format_cop(total_dom))
+    c3.metric("Gastos", f"-{format_cop(total_gastos)}")
+    c4.metric("Saldo disponible", format_cop(saldo))
+    by_method = totals_by_payment_method()
+    if not by_method.empty:
+        st.markdown("#### Ingresos por medio de pago")
+        st.dataframe(by_method.to_frame(), use_container_width=True)
+    with st.container(border=True):
+        st.subheader("Registro de movimientos entre medios (retiros, transferencias internas)")
+        with st.form("form_move", border=False):
+            st.number_input("Monto (COP)", min_value=MONTO_MIN_COP, step=MONTO_STEP_COP, key="move_amt")
+            st.selectbox("De (medio)", MEDIOS_PAGO, key="move_from")
+            st.selectbox("A (medio)", MEDIOS_PAGO, key="move_to")
+            st.text_input("Nota (opcional)", key="move_note")
+            st.form_submit_button("Registrar movimiento", on_click=_on_move_funds)
+        show_flash("move")
+
+    with st.container(border=True):
+        st.subheader("Agregar gasto")
+        with st.form("form_gasto", border=False):
+            st.text_input("Concepto", key="gasto_concepto")
+            st.number_input("Monto (COP)", min_value=MONTO_MIN_COP, step=MONTO_STEP_COP, key="gasto_monto")
+            st.form_submit_button("Agregar gasto", on_click=_on_add_expense)
+        show_flash("gasto")
+
+    with st.container(border=True):
+        st.subheader("Movimientos recientes")
+        df_flu = load_df("FlujoCaja", copy=False)
+        if not df_flu.empty:
+            st.dataframe(compact_for_display(df_flu.tail(200)), use_container_width=True)
+        df_g = load_df("Gastos", copy=False)
+        if not df_g.empty:
+            st.dataframe(compact_for_display(df_g.tail(200)), use_container_width=True)
+
+@st.fragment
+def render_reportes():
+    st.header("📈 Reportes y Exportes")
+    # Solo lectura: las tablas de la sesión se usan sin copiar en cada rerun
+    df_p = load_df("Pedidos", copy=False)
+    df_det = load_df("Pedidos_detalle", copy=False)
+    df_f = load_df("FlujoCaja", copy=False)
+    df_g = load_df("Gastos", copy=False)
+    df_inv = load_df("Inventario", copy=False)
+    df_prod = load_df("Productos", copy=False)
+
+    st.subheader("Pedidos (cabecera)")
+    paginated_dataframe(df_p, "page_pedidos")
+    st.subheader("Detalle Pedidos")
+    paginated_dataframe(df_det, "page_pedidos_detalle")
+    st.subheader("Flujo caja")
+    paginated_dataframe(df_f, "page_flujo")
+    st.subheader("Gastos")
+    paginated_dataframe(df_g, "page_gastos")
+    st.subheader("Inventario")
+    if not df_inv.empty:
+        paginated_dataframe(df_inv, "page_inventario", last_page_first=False)
+
+    st.markdown("---")
+    st.subheader("📊 Reportes de Análisis")
+    
+    st.markdown("##### 🏆 Clientes Más Valiosos")
+    top_clients_df = get_top_clients_report(df_p)
+    if not top_clients_df.empty:
+        paginated_dataframe(top_clients_df, "page_top_clientes", last_page_first=False)
+    else:
+        st.info("No hay datos para generar el reporte de clientes.")
+
+    st.markdown("##### 💰 Rentabilidad por Producto")
+    profitability_df = get_product_profitability_report(df_det, df_prod)
+    if not profitability_df.empty:
+        paginated_dataframe(profitability_df, "page_rentabilidad", last_page_first=False)
+    else:
+        st.info("No hay datos para generar el reporte. Asegúrate de haber definido los costos de los productos.")
+
+    st.markdown("---")
+    st.subheader("Exportar CSV locales")
+    paths_to_export = [CSV_CLIENTES, CSV_PEDIDOS, CSV_PEDIDOS_DETALLE, CSV_INVENTARIO, CSV_FLUJO, CSV_GASTOS, CSV_PRODUCTOS]
+    for path in paths_to_export:
+        if path.exists():
+            with open(path, "rb") as f:
+                st.download_button(f"Descargar {path.name}", f.read(), file_name=path.name, mime="text/csv")
+        else:
+            st.write(f"{path.name} no existe aún.")
+
+@st.fragment
+def render_dashboard():
+    st.header("📊 Dashboard — Resumen")
+    
+    with st.expander("📅 Filtrar por rango de fechas"):
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input("Fecha de inicio", value=datetime.now().date() - timedelta(days=30))
+        with col2:
+            end_date = st.date_input("Fecha de fin", value=datetime.now().date())
+    
+    # Solo lectura: las fechas se convierten aparte, sin tocar las tablas de la sesión
+    df_ped = load_df("Pedidos", copy=False)
+    df_det = load_df("Pedidos_detalle", copy=False)
+    df_flu = load_df("FlujoCaja", copy=False)
+    df_gas = load_df("Gastos", copy=False)
+    df_inv = load_df("Inventario", copy=False)
+    df_clients = load_df("Clientes", copy=False)
+
+    if not df_ped.empty:
+        mask = dates_in_range(pd.to_datetime(df_ped['Fecha'], errors='coerce'), start_date, end_date)
+        df_ped_filtered = df_ped.loc[mask]
+    else:
+        df_ped_filtered = pd.DataFrame()
+
+    total_orders = 0 if df_ped_filtered.empty else len(df_ped_filtered)
+    total_clients = 0 if df_clients.empty else df_clients["ID Cliente"].nunique()
+    total_revenue = 0
+    if not df_flu.empty:
+        mask_flu = dates_in_range(pd.to_datetime(df_flu['Fecha'], errors='coerce'), start_date, end_date)
+        df_flu_filtered = df_flu.loc[mask_flu]
+        total_revenue = int(df_flu_filtered["Ingreso_productos_recibido"].sum() + df_flu_filtered["Ingreso_domicilio_recibido"].sum())
+    total_expenses = 0 if df_gas.empty else int(pd.to_numeric(df_gas["Monto"], errors='coerce').sum())
+    balance = total_revenue - total_expenses
+
+    k1,k2,k3,k4 = st.columns(4)
+    k1.metric("Pedidos (en rango)", f"{int(total_orders):,}")
+    k2.metric("Clientes Totales", f"{int(total_clients):,}")
+    k3.metric("Ingresos (en rango)", f"{int(total_revenue):,} COP")
+    k4.metric("Saldo neto", f"{int(balance):,} COP")
+
+    st.markdown("---")
+    st.subheader("Ventas por producto (en rango)")
+    if not df_ped_filtered.empty and PLOTLY_AVAILABLE:
+        df_det_filtered = df_det[df_det["ID Pedido"].isin(df_ped_filtered["ID Pedido"])]
+        df_det_local = df_det_filtered.copy()
+        df_det_local["Subtotal"] = pd.to_numeric(df_det_local["Subtotal"], errors='coerce').fillna(0)
+        ventas_prod = df_det_local.groupby("Producto")["Subtotal"].sum().reset_index().sort_values("Subtotal", ascending=False)
+        fig = px.bar(ventas_prod, x="Producto", y="Subtotal", title="Ingresos por producto (COP)")
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.info("No hay detalle de pedidos para graficar en el rango seleccionado.")
+
+    st.markdown("---")
+    st.subheader("Stock actual")
+    if not df_inv.empty:
+        df_inv_local = df_inv.copy()
+        df_inv_local["Stock"] = pd.to_numeric(df_inv_local["Stock"], errors='coerce').fillna(0).astype(int)
+        st.dataframe(df_inv_local.sort_values("Stock"), use_container_width=True)
+    else:
+        st.info("Inventario vacío.")
+
+@st.fragment
+def render_productos():
     st.header("📦 Gestión de Productos")
-    df_productos = load_df("Productos")
+    df_productos = load_df("Productos", copy=False)
     st.dataframe(df_productos, use_container_width=True)
 
     with st.expander("➕ Agregar nuevo producto"):
@@ -1291,12 +2638,14 @@ elif menu == "Productos":
         if df_productos.empty:
             st.warning("No hay productos para editar.")
         else:
-            product_options = df_productos["ID Producto"].astype(str) + " - " + df_productos["Nombre"]
-            selected_product_option = st.selectbox("Selecciona un producto para editar", ["-- Seleccionar --"] + product_options.tolist())
+            product_by_id = dict(zip(df_productos["ID Producto"].tolist(), df_productos["Nombre"]))
+            selected_product_option = st.selectbox(
+                "Selecciona un producto para editar", [None] + list(product_by_id),
+                format_func=lambda pid: "-- Seleccionar --" if pid is None else f"{pid} - {product_by_id[pid]}")
 
-            if selected_product_option != "-- Seleccionar --":
-                product_id_to_edit = int(selected_product_option.split(" - ")[0])
-                product_data = df_productos[df_productos["ID Producto"].astype(int) == int(product_id_to_edit)].iloc[0]
+            if selected_product_option is not None:
+                product_id_to_edit = int(selected_product_option)
+                product_data = df_productos[df_productos["ID Producto"] == product_id_to_edit].iloc[0]
 
                 with st.form(key="edit_product_form"):
                     st.subheader(f"Editando: {product_data['Nombre']}")
@@ -1324,41 +2673,32 @@ elif menu == "Productos":
                         except Exception as e:
                             st.error(f"Error al eliminar producto: {e}")
 
-# ---------------------------
-# PEDIDOS (MEJORADO)
-# ---------------------------
-elif menu == "Pedidos":
+@st.fragment
+def render_pedidos():
     st.header("📦 Pedidos — Crear / Editar / Eliminar")
-    df_clients = load_df("Clientes")
-    df_ped = load_df("Pedidos")
-    df_det = load_df("Pedidos_detalle")
-    df_inv = load_df("Inventario")
-    df_productos = load_df("Productos")
+    # Solo lectura: la vista usa las tablas de la sesión sin copiarlas; el detalle sale de get_order_details
+    df_clients = load_df("Clientes", copy=False)
+    df_ped = load_df("Pedidos", copy=False)
+    # Listas de productos armadas una vez por versión de Productos (no por rerun ni por línea)
+    product_list, product_index, product_list_with_none = product_options()
 
     with st.expander("➕ Registrar nuevo pedido"):
         if df_clients.empty:
             st.warning("No hay clientes registrados. Agrega clientes en la sección de Clientes.")
         else:
-            client_options = df_clients["ID Cliente"].astype(int).astype(str) + " - " + df_clients["Nombre"]
-            client_options = client_options.tolist()
-            client_select = st.selectbox("Cliente", ["Seleccionar..."] + client_options)
-            if client_select == "Seleccionar...":
+            name_by_id = client_names()
+            new_cliente_id = st.selectbox(
+                "Cliente", [None] + list(name_by_id),
+                format_func=lambda cid: "Seleccionar..." if cid is None else f"{cid} - {name_by_id[cid]}")
+            if new_cliente_id is None:
                 st.info("Selecciona un cliente válido")
-                new_cliente_id = None
-            else:
-                try:
-                    new_cliente_id = int(client_select.split(" - ")[0])
-                except Exception:
-                    new_cliente_id = None
-                    st.error("Formato de cliente inválido. Selecciona de la lista.")
             
-            product_list = df_productos["Nombre"].tolist() if not df_productos.empty else []
             num_lines = st.number_input("Número de líneas", min_value=1, max_value=12, value=3)
             new_items = {}
             cols = st.columns(2)
             for i in range(int(num_lines)):
                 with cols[i % 2]:
-                    prod = st.selectbox(f"Producto {i+1}", ["-- Ninguno --"] + product_list, key=f"np_{i}")
+                    prod = st.selectbox(f"Producto {i+1}", product_list_with_none, key=f"np_{i}")
                     qty = st.number_input(f"Cantidad {i+1}", min_value=0, step=1, value=0, key=f"nq_{i}")
                 if prod and prod != "-- Ninguno --" and qty > 0:
                     new_items[prod] = new_items.get(prod, 0) + int(qty)
@@ -1382,22 +2722,18 @@ elif menu == "Pedidos":
         st.info("No hay pedidos registrados.")
     else:
         st.subheader("Listado de pedidos")
-        coerce_week = pd.to_numeric(df_ped["Semana_entrega"], errors='coerce').fillna(0).astype(int)
-        weeks = sorted(list(set(coerce_week.tolist())))
-        week_opts = ["Todas"] + [str(w) for w in weeks if w > 0]
-        week_filter = st.selectbox("Filtrar por semana (ISO)", week_opts)
+        week_filter = st.selectbox("Filtrar por semana (ISO)", pedidos_week_options())
         estado_filter = st.selectbox("Filtrar por estado", ["Todos", "Pendiente", "Entregado"])
-        df_view = df_ped.copy()
+        # La semana sale del índice precalculado por versión; el estado filtra solo esas filas (df_view no se modifica)
+        df_view = df_ped if week_filter == "Todas" else df_ped.take(pedidos_week_positions(df_ped).get(int(week_filter), []))
         if estado_filter != "Todos":
             df_view = df_view[df_view["Estado"] == estado_filter]
-        if week_filter != "Todas":
-            df_view = df_view[df_view["Semana_entrega"].astype(int) == int(week_filter)]
-        st.dataframe(df_view.reset_index(drop=True), use_container_width=True)
+        st.dataframe(compact_for_display(df_view.reset_index(drop=True)), use_container_width=True)
 
         if not df_view.empty:
             sel_id = st.selectbox("Selecciona ID Pedido para editar/eliminar", df_view["ID Pedido"].astype(int).tolist())
             if sel_id:
-                header = df_ped[df_ped["ID Pedido"].astype(int) == int(sel_id)].iloc[0].to_dict()
+                header = df_ped.loc[order_row(df_ped, sel_id)].to_dict()
                 detalle = get_order_details(sel_id)
                 st.markdown("### Detalle del pedido")
                 st.write(f"Cliente: **{header.get('Nombre Cliente','')}**")
@@ -1413,10 +2749,10 @@ elif menu == "Pedidos":
                 if detalle.empty:
                     st.info("No hay líneas de detalle para este pedido.")
                 else:
-                    for i, r in detalle.iterrows():
+                    for i, producto, cantidad in zip(detalle.index, detalle["Producto"], detalle["Cantidad"]):
                         cols = st.columns([4,2,1])
-                        prod = cols[0].selectbox(f"Producto {i+1}", product_list, index=product_list.index(r["Producto"]) if r["Producto"] in product_list else 0, key=f"ep_{i}")
-                        qty = cols[1].number_input(f"Cantidad {i+1}", min_value=0, step=1, value=int(r["Cantidad"]), key=f"eq_{i}")
+                        prod = cols[0].selectbox(f"Producto {i+1}", product_list, index=product_index.get(producto, 0), key=f"ep_{i}")
+                        qty = cols[1].number_input(f"Cantidad {i+1}", min_value=0, step=1, value=int(cantidad), key=f"eq_{i}")
                         remove = cols[2].checkbox("Eliminar", key=f"er_{i}")
                         if not remove:
                             edited_items[prod] = edited_items.get(prod, 0) + int(qty)
@@ -1425,7 +2761,7 @@ elif menu == "Pedidos":
                 if add_lines > 0:
                     for j in range(int(add_lines)):
                         a1,a2 = st.columns([4,2])
-                        pnew = a1.selectbox(f"Nuevo producto {j+1}", ["-- Ninguno --"] + product_list, key=f"np2_{j}")
+                        pnew = a1.selectbox(f"Nuevo producto {j+1}", product_list_with_none, key=f"np2_{j}")
                         qnew = a2.number_input(f"Nueva cantidad {j+1}", min_value=0, step=1, key=f"nq2_{j}")
                         if pnew and pnew != "-- Ninguno --" and qnew > 0:
                             edited_items[pnew] = edited_items.get(pnew, 0) + int(qnew)
@@ -1471,39 +2807,34 @@ elif menu == "Pedidos":
                         st.session_state.confirm_delete_order = sel_id
                         st.rerun()
 
-# ---------------------------
-# ENTREGAS / PAGOS
-# ---------------------------
-elif menu == "Entregas/Pagos":
+@st.fragment
+def render_entregas_pagos():
     st.header("🚚 Entregas y Pagos")
-    df_ped = load_df("Pedidos")
+    df_ped = load_df("Pedidos", copy=False)
     if df_ped.empty:
         st.info("No hay pedidos.")
     else:
         estado_choice = st.selectbox("Estado", ["Todos","Pendiente","Entregado"])
-        weeks = sorted(df_ped["Semana_entrega"].dropna().astype(int).unique().tolist()) if not df_ped.empty else []
-        week_opts = ["Todas"] + [str(w) for w in weeks if w > 0]
-        week_filter = st.selectbox("Semana (ISO)", week_opts)
-        df_view = df_ped.copy()
+        week_filter = st.selectbox("Semana (ISO)", pedidos_week_options())
+        df_view = df_ped if week_filter == "Todas" else df_ped.take(pedidos_week_positions(df_ped).get(int(week_filter), []))
         if estado_choice != "Todos":
             df_view = df_view[df_view["Estado"] == estado_choice]
-        if week_filter != "Todas":
-            df_view = df_view[df_view["Semana_entrega"].astype(int) == int(week_filter)]
-        st.dataframe(df_view.reset_index(drop=True), use_container_width=True)
+        st.dataframe(compact_for_display(df_view.reset_index(drop=True)), use_container_width=True)
 
         if not df_view.empty:
             ids = df_view["ID Pedido"].astype(int).tolist()
             selection = st.selectbox("Selecciona ID Pedido", ids)
-            idx = df_ped.index[df_ped["ID Pedido"].astype(int) == int(selection)][0]
-            row = df_ped.loc[idx]
+            row = df_ped.loc[order_row(df_ped, selection)]
             st.markdown(f"**Cliente:** {row['Nombre Cliente']}")
             st.markdown(f"**Total:** {int(row['Total_pedido']):,} COP  •  **Pagado:** {int(row['Monto_pagado']):,} COP  •  **Saldo:** {int(row['Saldo_pendiente']):,} COP")
             detalle = get_order_details(selection)
             if not detalle.empty:
-                st.table(detalle[["Producto","Cantidad","Precio_unitario","Subtotal"]].set_index(pd.Index(range(1,len(detalle)+1))))
+                detalle_view = detalle[["Producto","Cantidad","Precio_unitario","Subtotal"]]
+                detalle_view.index = pd.RangeIndex(1, len(detalle_view) + 1)
+                st.table(detalle_view)
             with st.form("form_payment"):
                 amount = st.number_input("Monto a pagar (COP)", min_value=0, step=1000, value=int(row.get("Saldo_pendiente",0)))
-                medio = st.selectbox("Medio de pago", ["Efectivo","Transferencia","Nequi","Daviplata"])
+                medio = st.selectbox("Medio de pago", MEDIOS_PAGO)
                 submit_payment = st.form_submit_button("Registrar pago")
                 if submit_payment:
                     try:
@@ -1512,197 +2843,83 @@ elif menu == "Entregas/Pagos":
                     except Exception as e:
                         st.error(f"Error registrando pago: {e}")
 
-# ---------------------------
-# INVENTARIO
-# ---------------------------
-elif menu == "Inventario":
+@st.fragment
+def render_inventario():
     st.header("📦 Inventario")
-    df_inv = load_df("Inventario")
+    df_inv = load_df("Inventario", copy=False)  # Stock ya llega entero desde canonical_inventory
     if df_inv.empty:
         st.info("Inventario vacío.")
     else:
-        df_inv["Stock"] = pd.to_numeric(df_inv["Stock"], errors='coerce').fillna(0).astype(int)
         st.dataframe(df_inv.sort_values("Stock"), use_container_width=True)
 
     st.markdown("### Ajuste manual de stock (permite negativo)")
-    df_inv_local = load_local_csv(CSV_INVENTARIO, HEAD_INVENTARIO)
-    df_inv_local["Stock"] = pd.to_numeric(df_inv_local["Stock"], errors='coerce').fillna(0).astype(int)
-    prod_list = sorted(df_inv_local["Producto"].astype(str).unique().tolist()) if not df_inv_local.empty else load_df("Productos")["Nombre"].tolist()
+    # load_df ya entrega el inventario canónico (un nombre por producto, ordenado): sin releer ni agrupar el CSV
+    prod_list = df_inv["Producto"].tolist() if not df_inv.empty else product_options()[0]
     prod_sel = st.selectbox("Producto", prod_list)
     delta = st.number_input("Cantidad a sumar/restar (negativo para restar)", value=0, step=1)
     reason = st.text_input("Motivo (opcional)")
 
     if st.button("Aplicar ajuste"):
         try:
-            if prod_sel in df_inv_local["Producto"].values:
-                idx = df_inv_local.index[df_inv_local["Producto"] == prod_sel][0]
-                df_inv_local.at[idx, "Stock"] = int(df_inv_local.at[idx, "Stock"]) + int(delta)
-            else:
-                df_inv_local = pd.concat([df_inv_local, pd.DataFrame([[prod_sel, int(delta)]], columns=HEAD_INVENTARIO)], ignore_index=True)
-            df_inv_local = df_inv_local.groupby("Producto", as_index=False).agg({"Stock":"sum"})
-            save_local_csv_by_sheet("Inventario", df_inv_local)
-            try:
-                safe_write_df_to_sheet(df_inv_local, "Inventario", HEAD_INVENTARIO)
-            except Exception:
-                pass
-            flush_cache()
+            prod_adj = canonical_product_name(prod_sel)
+            with data_write_lock():
+                # Se relee dentro del lock (versión publicada más reciente): otra sesión pudo mover el stock
+                df_inv_adj = apply_inventory_delta(load_df("Inventario", copy=False), {prod_adj: int(delta)})
+                persist_row_changes([(df_inv_adj, "Inventario", HEAD_INVENTARIO, "Producto", [prod_adj])],
+                                    context=f"inventory adjustment for {prod_adj}")
             st.success("Ajuste aplicado al inventario.")
             log_info(f"Inventory adjusted: {prod_sel} -> delta {delta} reason: {reason}")
         except Exception as e:
             st.error(f"Error aplicando ajuste de inventario: {e}")
 
-# ---------------------------
-# FLUJO & GASTOS
-# ---------------------------
-elif menu == "Flujo & Gastos":
-    st.header("💰 Flujo de caja y Gastos")
-    total_prod, total_dom, total_gastos, saldo = flow_summaries()
-    c1,c2,c3,c4 = st.columns([3,2,2,1])
-    c1.metric("Ingresos productos", f"{int(total_prod):,} COP".replace(",","."))
-    c2.metric("Ingresos domicilios", f"{int(total_dom):,} COP".replace(",","."))
-    c3.metric("Gastos", f"-{int(total_gastos):,} COP".replace(",","."))
-    c4.metric("Saldo disponible", f"{int(saldo):,} COP".replace(",","."))
-    st.markdown("---")
-    st.subheader("Registro de movimientos entre medios (retiros, transferencias internas)")
-    with st.form("form_move"):
-        amt = st.number_input("Monto (COP)", min_value=0.0, step=1000.0)
-        from_m = st.selectbox("De (medio)", ["Transferencia","Efectivo","Nequi","Daviplata"])
-        to_m = st.selectbox("A (medio)", ["Efectivo","Transferencia","Nequi","Daviplata"])
-        note = st.text_input("Nota (opcional)", value="Movimiento interno")
-        submit_move = st.form_submit_button("Registrar movimiento")
-        if submit_move:
-            if amt <= 0:
-                st.error("Monto debe ser mayor a 0")
-            elif from_m == to_m:
-                st.error("Los medios deben ser diferentes")
-            else:
-                try:
-                    move_funds(amt, from_m, to_m, note)
-                    st.success("Movimiento registrado")
-                except Exception as e:
-                    st.error(f"Error registrando movimiento: {e}")
-
-    st.markdown("---")
-    st.subheader("Agregar gasto")
-    with st.form("form_gasto"):
-        concepto = st.text_input("Concepto")
-        monto_g = st.number_input("Monto (COP)", min_value=0.0, step=1000.0)
-        add_gasto = st.form_submit_button("Agregar gasto")
-        if add_gasto:
-            try:
-                add_expense(concepto, float(monto_g))
-                st.success("Gasto agregado.")
-            except Exception as e:
-                st.error(f"Error agregando gasto: {e}")
-
-    st.markdown("---")
-    st.subheader("Movimientos recientes")
-    df_flu = load_df("FlujoCaja")
-    if not df_flu.empty:
-        st.dataframe(df_flu.tail(200), use_container_width=True)
-    df_g = load_df("Gastos")
-    if not df_g.empty:
-        st.dataframe(df_g.tail(200), use_container_width=True)
-
-# ---------------------------
-# REPORTES
-# ---------------------------
-elif menu == "Reportes":
-    st.header("📈 Reportes y Exportes")
-    df_p = load_df("Pedidos")
-    df_det = load_df("Pedidos_detalle")
-    df_f = load_df("FlujoCaja")
-    df_g = load_df("Gastos")
-    df_inv = load_df("Inventario")
-    df_prod = load_df("Productos")
-
-    st.subheader("Pedidos (cabecera)")
-    st.dataframe(df_p, use_container_width=True)
-    st.subheader("Detalle Pedidos")
-    st.dataframe(df_det, use_container_width=True)
-    st.subheader("Flujo caja")
-    st.dataframe(df_f, use_container_width=True)
-    st.subheader("Gastos")
-    st.dataframe(df_g, use_container_width=True)
-    st.subheader("Inventario")
-    if not df_inv.empty:
-        st.dataframe(df_inv, use_container_width=True)
-
-    st.markdown("---")
-    st.subheader("📊 Reportes de Análisis")
-    
-    st.markdown("##### 🏆 Clientes Más Valiosos")
-    top_clients_df = get_top_clients_report(df_p)
-    if not top_clients_df.empty:
-        st.dataframe(top_clients_df, use_container_width=True)
-    else:
-        st.info("No hay datos para generar el reporte de clientes.")
-
-    st.markdown("##### 💰 Rentabilidad por Producto")
-    profitability_df = get_product_profitability_report(df_det, df_prod)
-    if not profitability_df.empty:
-        st.dataframe(profitability_df, use_container_width=True)
-    else:
-        st.info("No hay datos para generar el reporte. Asegúrate de haber definido los costos de los productos.")
-
-    st.markdown("---")
-    st.subheader("Exportar CSV locales")
-    paths_to_export = [CSV_CLIENTES, CSV_PEDIDOS, CSV_PEDIDOS_DETALLE, CSV_INVENTARIO, CSV_FLUJO, CSV_GASTOS, CSV_PRODUCTOS]
-    for path in paths_to_export:
-        if path.exists():
-            with open(path, "rb") as f:
-                st.download_button(f"Descargar {path.name}", f.read(), file_name=path.name, mime="text/csv")
-        else:
-            st.write(f"{path.name} no existe aún.")
-
-# ---------------------------
-# FACTURACIÓN (MEJORADO)
-# ---------------------------
-elif menu == "Facturación 🧾":
+@st.fragment
+def render_facturacion():
     st.header("🧾 Facturación")
     if not PDF_AVAILABLE:
         st.error("La librería 'reportlab' no está instalada. Por favor, ejecuta `pip install reportlab` para habilitar esta función.")
-        st.stop()
+        return
 
-    df_ped = load_df("Pedidos")
+    df_ped = load_df("Pedidos", copy=False)
     if df_ped.empty:
         st.warning("No hay pedidos registrados para facturar.")
-        st.stop()
+        return
 
     df_facturables = df_ped[df_ped["Estado"] == "Entregado"]
     if df_facturables.empty:
         st.info("No hay pedidos con estado 'Entregado' para facturar.")
-        st.stop()
+        return
     
     st.subheader("Seleccionar Pedido a Facturar")
-    df_facturables['Numero Factura'] = df_facturables['Numero Factura'].fillna('Sin Factura')
-    order_options = (
-        df_facturables["ID Pedido"].astype(str) + " - " + 
-        df_facturables["Nombre Cliente"] + " - Total: " + 
-        df_facturables["Total_pedido"].astype(int).apply(lambda x: f"{x:,} COP") +
-        " - Factura: " + df_facturables['Numero Factura'].astype(str)
-    )
-    selected_order_option = st.selectbox("Pedidos Entregados", order_options)
+    # (cliente, total, factura) por pedido, armado columna a columna sin un dict por fila
+    facturables_by_id = {
+        int(oid): datos for oid, *datos in zip(df_facturables["ID Pedido"], df_facturables["Nombre Cliente"],
+                                               df_facturables["Total_pedido"], df_facturables["Numero Factura"].fillna("Sin Factura"))
+    }
+    selected_order_option = st.selectbox(
+        "Pedidos Entregados", list(facturables_by_id),
+        format_func=lambda oid: (f"{oid} - {facturables_by_id[oid][0]} - Total: "
+                                 f"{int(facturables_by_id[oid][1]):,} COP - Factura: {facturables_by_id[oid][2]}"))
     
-    if selected_order_option:
-        order_id = int(selected_order_option.split(" - ")[0])
+    if selected_order_option is not None:
+        order_id = int(selected_order_option)
         
-        df_ped = load_df("Pedidos")
-        current_invoice_num = df_ped.loc[df_ped["ID Pedido"].astype(int) == int(order_id), "Numero Factura"].iloc[0]
+        # Lectura, asignación y guardado del número bajo el lock: dos sesiones no numeran el mismo pedido dos veces
+        with data_write_lock():
+            # Solo se copia la tabla cuando hay que asignar número; volver a generar el PDF no la toca
+            df_ped = load_df("Pedidos", copy=False)
+            idx = order_row(df_ped, order_id)
+            current_invoice_num = df_ped.at[idx, "Numero Factura"]
         
-        if pd.isna(current_invoice_num) or current_invoice_num == "":
-            invoice_number_to_use = get_next_invoice_number()
-            df_ped.loc[df_ped["ID Pedido"] == order_id, "Numero Factura"] = invoice_number_to_use
-            save_local_csv_by_sheet("Pedidos", df_ped)
-            try:
-                safe_write_df_to_sheet(df_ped, "Pedidos", HEAD_PEDIDOS)
-            except Exception as e:
-                log_warn(f"Best-effort sync failed to update invoice number for order {order_id}: {e}")
-            flush_cache()
-            st.info(f"Se ha asignado el número de factura #{invoice_number_to_use:03d} a este pedido.")
-        else:
-            invoice_number_to_use = int(current_invoice_num)
-            st.info(f"Este pedido ya tiene la factura #{invoice_number_to_use:03d}. Se volverá a generar el PDF con el mismo número.")
+            if pd.isna(current_invoice_num) or current_invoice_num == "":
+                invoice_number_to_use = get_next_invoice_number()
+                df_ped = df_ped.copy()
+                df_ped.at[idx, "Numero Factura"] = invoice_number_to_use
+                persist_row_changes([(df_ped, "Pedidos", HEAD_PEDIDOS, "ID Pedido", [order_id])],
+                                    context=f"invoice number for order {order_id}")
+                st.info(f"Se ha asignado el número de factura #{invoice_number_to_use:03d} a este pedido.")
+            else:
+                invoice_number_to_use = int(current_invoice_num)
+                st.info(f"Este pedido ya tiene la factura #{invoice_number_to_use:03d}. Se volverá a generar el PDF con el mismo número.")
 
         if st.button("Generar Factura PDF", type="primary"):
             with st.spinner("Generando factura..."):
@@ -1724,7 +2941,7 @@ elif menu == "Facturación 🧾":
                 st.write(f"Tamaño del archivo: {os.path.getsize(pdf_path)} bytes.")
             else:
                 st.error("❌ El archivo PDF no se encontró en la ruta especificada.")
-                st.stop()
+                return
 
             try:
                 with open(pdf_path, "rb") as pdf_file:
@@ -1747,10 +2964,8 @@ elif menu == "Facturación 🧾":
                     mime="application/pdf"
                 )
 
-# ---------------------------
-# SINCRONIZACIÓN & CONFIG
-# ---------------------------
-elif menu == "Sincronización":
+@st.fragment
+def render_sincronizacion():
     st.header("🔄 Sincronización con Google Sheets (manual / diagnóstico)")
     st.write("Estado actual del cliente Google Sheets y del Spreadsheet.")
     st.write(f"gspread disponible: {GS_AVAILABLE}")
@@ -1768,15 +2983,18 @@ elif menu == "Sincronización":
             df_gas = load_local_csv(CSV_GASTOS, HEAD_GASTOS)
             df_prod = load_local_csv(CSV_PRODUCTOS, HEAD_PRODUCTOS)
             
-            ok_clients = safe_write_df_to_sheet(df_clients, "Clientes", HEAD_CLIENTES)
-            ok_ped = safe_write_df_to_sheet(df_ped, "Pedidos", HEAD_PEDIDOS)
-            ok_det = safe_write_df_to_sheet(df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE)
-            ok_inv = safe_write_df_to_sheet(df_inv, "Inventario", HEAD_INVENTARIO)
-            ok_flu = safe_write_df_to_sheet(df_flu, "FlujoCaja", HEAD_FLUJO)
-            ok_gas = safe_write_df_to_sheet(df_gas, "Gastos", HEAD_GASTOS)
-            ok_prod = safe_write_df_to_sheet(df_prod, "Productos", HEAD_PRODUCTOS)
+            wait_for_sheet_writes()
+            ok_all = safe_write_dfs_to_sheets([
+                (df_clients, "Clientes", HEAD_CLIENTES),
+                (df_ped, "Pedidos", HEAD_PEDIDOS),
+                (df_det, "Pedidos_detalle", HEAD_PEDIDOS_DETALLE),
+                (df_inv, "Inventario", HEAD_INVENTARIO),
+                (df_flu, "FlujoCaja", HEAD_FLUJO),
+                (df_gas, "Gastos", HEAD_GASTOS),
+                (df_prod, "Productos", HEAD_PRODUCTOS),
+            ], rebase=False)
             
-            if ok_clients and ok_ped and ok_det and ok_inv and ok_flu and ok_prod and ok_gas:
+            if ok_all:
                 st.success("Intento de sincronización iniciado (revisa logs para detalles).")
                 log_info("Manual sync local->sheets requested by user.")
             else:
@@ -1794,6 +3012,66 @@ elif menu == "Sincronización":
     else:
         st.info("No hay logs todavía.")
 
+# ---------------------------
+# DASHBOARD
+# ---------------------------
+if menu == "Dashboard":
+    render_dashboard()
+
+# ---------------------------
+# CLIENTES
+# ---------------------------
+elif menu == "Clientes":
+    render_clientes()
+
+# ---------------------------
+# NUEVO: PRODUCTOS (CRUD)
+# ---------------------------
+elif menu == "Productos":
+    render_productos()
+
+# ---------------------------
+# PEDIDOS (MEJORADO)
+# ---------------------------
+elif menu == "Pedidos":
+    render_pedidos()
+
+# ---------------------------
+# ENTREGAS / PAGOS
+# ---------------------------
+elif menu == "Entregas/Pagos":
+    render_entregas_pagos()
+
+# ---------------------------
+# INVENTARIO
+# ---------------------------
+elif menu == "Inventario":
+    render_inventario()
+
+# ---------------------------
+# FLUJO & GASTOS
+# ---------------------------
+elif menu == "Flujo & Gastos":
+    render_flujo_gastos()
+
+# ---------------------------
+# REPORTES
+# ---------------------------
+elif menu == "Reportes":
+    render_reportes()
+
+# ---------------------------
+# FACTURACIÓN (MEJORADO)
+# ---------------------------
+elif menu == "Facturación 🧾":
+    render_facturacion()
+
+# ---------------------------
+# SINCRONIZACIÓN & CONFIG
+# ---------------------------
+elif menu == "Sincronización":
+    render_sincronizacion()
+
 # Footer
 st.markdown("---")
 st.caption("AndicBlue — App local con respaldo CSV y sincronización controlada con Google Sheets. Diseñado para operar localmente y evitar errores por cuota de la API.")